@@ -23,6 +23,7 @@ while game.running:
     # We generally use a while loop when making a game. Most of the game code should go here.
     screen.fill("skyblue" if game.level in (0, 5, 6, 7) or game.showing_gui else "darkgray")
     dt = clock.tick(60)  # this ensures that the game cannot run higher that 60FPS. We also get a delta time in ms.
+    game.client.run_pending()  # what the network thread needs done on this thread (like loading a map)
 
     if game.showing_gui:
         if game.inputting_nickname:
@@ -0,0 +1,25 @@
+class DoubleBuffer:
+    """
+    Hands the latest value written by one thread (the network) to another one (the game loop), without locks.
+
+    The writer builds a whole new value and publishes it along with a version number in a single assignment,
+    which is atomic in CPython: the reader can only ever see complete values.
+    Values written between two reads are skipped, only the latest one matters.
+    There must be a single writer.
+    """
+
+    def __init__(self):
+        self._latest = (0, None)
+        self._read = 0
+
+    def write(self, value):
+        """Publishes a new value. `value` must not be changed afterwards."""
+        self._latest = (self._latest[0] + 1, value)
+
+    def read(self):
+        """Returns the latest value if it wasn't read yet, None otherwise."""
+        version, value = self._latest
+        if version == self._read:
+            return None
+        self._read = version
+        return value
@@ -1,17 +1,23 @@
 import asyncio
 import json
+import os
 import os.path as path
 import pathlib
+import queue
 import socket
 import ssl
 import threading
+import time
 from asyncio.exceptions import CancelledError, IncompleteReadError
 from operator import itemgetter
 
 import websockets
 from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
 
+from ..server import protocol
+from .buffer import DoubleBuffer
 from .cache import CacheManager  # relative import otherwise it doesn't work
+from .prediction import Prediction
 
 
 def _resource_path(file: str):
@@ -25,6 +31,20 @@ ssl_context.load_verify_locations(_resource_path("assets/cert.pem"))
 cache = CacheManager()
 player_nickname = itemgetter("nickname")
 player_level = itemgetter("level")
+# How many decoded snapshots we keep around, waiting to be used as a delta baseline by the server.
+SNAPSHOT_HISTORY = 32
+SERVER_URL = "wss://oldfashionedorcs.servegame.com"
+SERVER_PORT = 8001
+# Wire protocols offered to the server, by preference. Set ORCS_PROTOCOLS=json to debug with readable messages.
+PROTOCOLS = os.environ.get("ORCS_PROTOCOLS", ",".join(protocol.SUPPORTED)).split(",")
+# Ask the server to send everything (updates, pings...) on the main connection, instead of opening a second one.
+MULTIPLEX = True
+# How many "play" events can be sent before the server acknowledges the first of them.
+MAX_INPUTS_IN_FLIGHT = 8
+# How many "play" events we send per second at most, moves in between are coalesced into the latest one.
+SEND_RATE = 20
+# How long (in seconds) `stop` waits for the goodbyes to the server before cutting the connection.
+STOP_TIMEOUT = 2
 
 
 class Client:
@@ -37,22 +57,74 @@ class Client:
         self.payload = {}
         self.unique_id = None
         self.running = False
+        self.protocol = protocol.JSON
+        # True when the server agreed to multiplex everything on the main connection.
+        self.mux = False
+        # The server may redirect us to the port of the worker process that owns our session.
+        self.port = SERVER_PORT
+        # Decoded snapshots by sequence number (player id => player data).
+        self.snapshots = {}
+        # Round trip time to the server (as a string, in seconds), sent along some updates.
+        self.latency = None
+        # Sequence number of the last "play" event sent, and of the last one the server acknowledged.
+        self.input_seq = 0
+        self.input_ack = 0
+        # Where we predicted to be for each of them, to agree with the server when it didn't accept some.
+        self.prediction = Prediction()
+        self.send_rate = SEND_RATE
+        # Latest (position, level, direction) published by the game loop, and how to wake up the sender.
+        self.published = None
+        self.send_wakeup = None
+        # All the networking runs on this thread, in this event loop, as a single task.
+        self.thread = None
+        self.loop = None
+        self.task = None
+        # Calls the network thread wants the game loop to make, see `run_pending`.
+        self.pending = queue.SimpleQueue()
+        # Other players of the latest snapshot (nickname => (direction, position)), written by the network thread.
+        self.remote_players = DoubleBuffer()
 
-    async def _sync_engine(self):
-        """Sync real game data to send back to the server!"""
-        data = {
-            "type": "play",
-            "position": list(self.game.player.rect.topleft),
-            "level": self.game.level,
-            "direction": self.game.player.direction,
-        }
-        return data
+    def publish(self, position, level, direction):
+        """Called by the game loop every frame: wakes up the sender if the player moved. Thread-safe."""
+        state = (tuple(position), level, direction)
+        if state == self.published:
+            return
+        self.published = state
+        self._wake_sender()
+
+    def _wake_sender(self):
+        """Wakes up `_play`, from any thread."""
+        # The network thread clears both when it stops, read them once.
+        loop, send_wakeup = self.loop, self.send_wakeup
+        if loop is not None and send_wakeup is not None and not send_wakeup.is_set():
+            try:
+                loop.call_soon_threadsafe(send_wakeup.set)
+            except RuntimeError:
+                # The loop is already closed, we are disconnecting.
+                pass
+
+    def call_in_game(self, function, *args):
+        """Asks the game loop to call `function(*args)` on its next frame. Thread-safe."""
+        self.pending.put((function, args))
+
+    def run_pending(self):
+        """Called by the game loop every frame, makes the calls the network thread asked for."""
+        while True:
+            try:
+                function, args = self.pending.get_nowait()
+            except queue.Empty:
+                return
+            function(*args)
+
+    def _url(self):
+        """Returns the address of the server."""
+        return f"{SERVER_URL}:{self.port}/"
 
     async def _hello(self, cache_data):
         """Typical client/server hello connection"""
         no_cache = True if not all(cache_data.values()) else False
 
-        hi = json.dumps(cache_data)
+        hi = json.dumps(dict(cache_data, protocols=PROTOCOLS, mux=MULTIPLEX))
         await self.websocket.send(hi)
         print(f"Client hello => {hi}")
 
@@ -60,8 +132,20 @@ class Client:
         response = json.loads(response)
         print(f"Server hello => {response}")
 
+        if response["type"] == "redirect":
+            # Another server worker owns our session, we have to connect to it instead.
+            self.port = response["port"]
+            return None
+
         if response["type"] in ["init", "ready"]:
             self.game.nickname = response["nickname"]
+            self.protocol = response.get("protocol", protocol.JSON)
+            self.mux = response.get("mux", False)
+            self.snapshots = {}
+            self.input_seq = self.input_ack = 0
+            self.prediction.reset()
+            # Nobody is around until the first snapshot.
+            self.remote_players.write((time.monotonic(), {}))
 
             if not cache_data["unique_id"]:
                 # If user didnt have a unique_id, server returned him one
@@ -78,81 +162,179 @@ class Client:
                 self.game.level = response["level"]
             else:
                 self.game.level = 0
-            self.game.read_map(f"maps/level{self.game.level}.tmx")
+            # Sprites belong to the game loop.
+            self.call_in_game(self.game.read_map, f"maps/level{self.game.level}.tmx")
             self.unique_id = cache_data["unique_id"]
             return cache_data
 
     async def _broadcast(self):
-        """Listener for game broadcasts."""
-        init = False
-        # Wait for the response/update and process it
+        """Listener for game broadcasts, started once the hello told us our unique_id (and our server's port)."""
         try:
-            async with websockets.connect(
-                "wss://oldfashionedorcs.servegame.com:8001/", close_timeout=1, ssl=ssl_context
-            ) as self.broadcast:
-                while self.running:
-                    # Make sure main thread actually initialized
-                    if not self.unique_id:
-                        await asyncio.sleep(0.1)
-                        continue
+            redirected = True
+            while self.running and redirected:
+                redirected = False
+                async with websockets.connect(self._url(), close_timeout=1, ssl=ssl_context) as self.broadcast:
                     # First payload on this websocket needs to include unique_id
                     # So that the server can identify it and assign the socket to the same player
-                    if not init:
-                        await self.broadcast.send(json.dumps({"type": "broadcast", "unique_id": self.unique_id}))
-                        init = True
+                    self.snapshots = {}
+                    await self.broadcast.send(json.dumps({"type": "broadcast", "unique_id": self.unique_id}))
                     # Now that we have initiliased, wait for actual updates/pings!
-                    response = await self.broadcast.recv()
-                    response = json.loads(response)
-                    if response["type"] == "update":
-                        print(f"Public Broadcast => {response}")
-                        await self._sync_players(response)
-                    elif response["type"] == "ping":
-                        print(f"Private Ping Broadcast => {response}")
-        except socket.gaierror:
+                    redirected = await self._listen(self.broadcast)
+        except (socket.gaierror, ConnectionClosedOK, ConnectionClosedError, IncompleteReadError):
+            print("Lost the broadcast connection.")
             self.running = False
-            print("Cannot connect to server. Try again later!")
-        except ConnectionClosedOK:
+            # Let the play loop say goodbye.
+            self._wake_sender()
+
+    async def _multiplexed(self):
+        """Listener for everything the server sends on the main connection, when it is multiplexed."""
+        try:
+            await self._listen(self.websocket)
+        except (ConnectionClosedOK, ConnectionClosedError, IncompleteReadError):
+            print("Lost the connection.")
             self.running = False
-            print("Server closed your connection.")
+            # Let the play loop say goodbye.
+            self._wake_sender()
 
-    async def _sync_players(self, response):
-        """Update OtherPlayers from broadcasts!"""
-        nicknames = []
+    async def _listen(self, websocket):
+        """Receive updates and pings. Returns True if the server redirected us to another worker."""
+        while self.running:
+            response = await websocket.recv()
+            response = protocol.decode(response)
+            if response["type"] == "update":
+                print(f"Public Broadcast => {response}")
+                if "latency" in response:
+                    self.latency = response["latency"]
+                players = self._apply_snapshot(response)
+                if "ack" in response:
+                    self._acknowledge_inputs(response["ack"], players)
+                if players is None:
+                    # We don't have its baseline anymore, the server will send a full one.
+                    continue
+                ack = {"type": "ack", "seq": response["seq"]}
+                await websocket.send(protocol.encode(ack, self.protocol))
+                self._publish_players(players)
+            elif response["type"] == "inputs":
+                # Nothing changed since the last update, it tells where the server has us.
+                self._acknowledge_inputs(response["ack"], self.snapshots.get(max(self.snapshots, default=None)))
+            elif response["type"] == "ping":
+                # Older servers send the latency on its own.
+                self.latency = response["latency"]
+            elif response["type"] == "play":
+                # Only when multiplexed, the server checked our payload.
+                print(f"Private Response => {response}")
+            elif response["type"] == "redirect":
+                self.port = response["port"]
+                return True
+        return False
+
+    def _acknowledge_inputs(self, ack, players=None):
+        """The server processed every "play" event up to `ack`, `players` is its state right after."""
+        if ack > self.input_ack:
+            self.input_ack = ack
+            # Moves may be waiting for room in the window of inputs in flight.
+            self._wake_sender()
+        for player in (players or {}).values():
+            if player.get("nickname") == self.game.nickname:
+                self.prediction.confirm(ack, player["level"], player["position"])
+                break
+
+    def _apply_snapshot(self, response):
+        """Rebuilds the full snapshot from a delta update and its baseline."""
+        baseline = response["baseline"]
+        if baseline is None:
+            players = {}
+        elif baseline in self.snapshots:
+            players = {player_id: dict(player) for player_id, player in self.snapshots[baseline].items()}
+        else:
+            return None
         for player in response["players"]:
+            players.setdefault(player["id"], {}).update(player)
+        for player_id in response.get("left", []):
+            players.pop(player_id, None)
+
+        # The server never goes back to a baseline older than the one it just used.
+        self.snapshots = {seq: old for seq, old in self.snapshots.items() if baseline is not None and seq >= baseline}
+        self.snapshots[response["seq"]] = players
+        if len(self.snapshots) > SNAPSHOT_HISTORY:
+            del self.snapshots[min(self.snapshots)]
+        return players
+
+    def _publish_players(self, players):
+        """Hands the other players on our level to the game loop, see `sync_players`."""
+        remote = {}
+        for player in players.values():
             nick = player_nickname(player)
-            level = player_level(player)
-            nicknames.append(nick)
-            if nick == self.payload["nickname"] or level != self.payload["level"]:
-                continue
-            if not any(ply for ply in self.game.other_players if ply.nickname == nick):
-                self.game.add_player(nick, player["direction"], player["position"])
+            if nick == self.payload["nickname"] or player_level(player) != self.payload["level"]:
                 continue
-            self.game.update_player(nick, player["direction"], player["position"])
-        self.game.check_who_left(nicknames)
+            remote[nick] = (player["direction"], tuple(player["position"]))
+        # Other players are interpolated between snapshots, by when they were received.
+        self.remote_players.write((time.monotonic(), remote))
+
+    def sync_players(self):
+        """
+        Update OtherPlayers from broadcasts!
+
+        Called by the game loop every frame, only the latest snapshot is applied.
+        Every player still there gets a sample from it, even if it didn't move: that's how interpolation
+        knows it stopped.
+        """
+        snapshot = self.remote_players.read()
+        if snapshot is None:
+            return
+        received_at, remote = snapshot
+        known = self.game.other_players_by_nickname
+        if not known.keys() <= remote.keys():
+            self.game.check_who_left(remote)
+        for nick, state in remote.items():
+            if nick in known:
+                self.game.update_player(nick, *state, received_at)
+            else:
+                self.game.add_player(nick, *state, received_at)
 
     async def _play(self, data):
-        """Play loop"""
+        """
+        Play loop: sends the moves published by the game loop.
+
+        It sleeps until the player moves, and then sends at most `send_rate` events per second:
+        moves made in between are coalesced, only the latest position is sent.
+        """
+        loop = asyncio.get_running_loop()
+        # In case the player moved before we were ready.
+        self.send_wakeup.set()
         history = {"position": [0, 0], "level": -100}
+        next_send = loop.time()
         while self.running:
-            data = await self._sync_engine()
-            self.payload.update(data)
+            await self.send_wakeup.wait()
+            delay = next_send - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.send_wakeup.clear()
+            if not self.running or self.published is None:
+                continue
+            position, level, direction = self.published
+            self.payload.update(type="play", position=list(position), level=level, direction=direction)
 
             # When moving & on spawn inform the server!
             if self.payload["position"] != history["position"] or self.payload["level"] != history["level"]:
+                if self.input_seq - self.input_ack >= MAX_INPUTS_IN_FLIGHT:
+                    # The server is behind, our latest position goes out when it acknowledges something.
+                    continue
                 # Update history dict
                 history["position"] = self.payload["position"]
                 history["level"] = self.payload["level"]
-                # Send the payload
+                next_send = loop.time() + 1 / self.send_rate
+                # Send the payload, the server acknowledges it along our next update.
+                self.input_seq += 1
+                self.payload["seq"] = self.input_seq
+                self.prediction.record(self.input_seq, self.payload["level"], self.payload["position"])
                 print(f"Payload => {self.payload}")
-                await self.websocket.send(json.dumps(self.payload))
-                # Wait for the check
-                response = await self.websocket.recv()
-                response = json.loads(response)
-                print(f"Private Response => {response}")
+                await self.websocket.send(protocol.encode(self.payload, self.protocol))
         else:
-            exit = json.dumps({"type": "exit"})
+            exit = protocol.encode({"type": "exit"}, self.protocol)
             await self.websocket.send(exit)
-            await self.broadcast.send(exit)
+            if not self.mux:
+                await self.broadcast.send(exit)
 
     async def _main(self):
         """Main client websocket"""
@@ -166,14 +348,27 @@ class Client:
         del cache_nick
 
         try:
-            async with websockets.connect(
-                "wss://oldfashionedorcs.servegame.com:8001/", close_timeout=1, ssl=ssl_context
-            ) as self.websocket:
-                # Send the first data to initialize the connection
-                self.payload = await self._hello(cache_data)
-                # Now play the game
-                self.payload["nickname"] = self.game.nickname
-                await self._play(self.payload)
+            payload = None
+            while payload is None:
+                async with websockets.connect(self._url(), close_timeout=1, ssl=ssl_context) as self.websocket:
+                    # Send the first data to initialize the connection
+                    payload = await self._hello(cache_data)
+                    if payload is None:
+                        # We got redirected to another server worker.
+                        continue
+                    self.payload = payload
+                    # Now play the game
+                    self.payload["nickname"] = self.game.nickname
+                    if self.mux:
+                        # Everything comes through this connection.
+                        listener = asyncio.create_task(self._multiplexed())
+                    else:
+                        listener = asyncio.create_task(self._broadcast())
+                    try:
+                        await self._play(self.payload)
+                    finally:
+                        listener.cancel()
+                        await asyncio.gather(listener, return_exceptions=True)
         except socket.gaierror:
             self.running = False
             print("Cannot connect to server. Try again later!")
@@ -182,43 +377,46 @@ class Client:
             print("Server closed your connection.")
 
     def start(self):
-        """Starts the listen/receive threads."""
-        # The main thread.
-        self.main_thread = threading.Thread(target=self._main_start, daemon=True)
-        # Broadcast listener thread
-        self.recv_thread = threading.Thread(target=self._recv_start, daemon=True)
+        """Starts the network thread."""
+        self.running = True
         # We make it "daemon" so that the full process stops when the window is closed.
         # (If the thread is not daemon, we get a RuntimeError upon closing the window.)
-        self.main_thread.start()
-        self.recv_thread.start()
-        self.running = True
+        self.thread = threading.Thread(target=self._run, name="network", daemon=True)
+        self.thread.start()
 
     def stop(self):
-        """Stops the listen/receive threads."""
+        """Stops the network thread, after telling the server we are leaving if we can."""
         self.running = False
-        print("Exiting Recv Thread")
-        self.recv_thread.join()
-        print("Exiting Main Thread")
-        self.main_thread.join()
+        if self.thread is None:
+            return
+        self._wake_sender()
+        print("Exiting Network Thread")
+        self.thread.join(timeout=STOP_TIMEOUT)
+        if self.thread.is_alive():
+            # Still connecting, or the server doesn't answer: no need to wait any longer.
+            try:
+                self.loop.call_soon_threadsafe(self.task.cancel)
+            except (AttributeError, RuntimeError):
+                # The loop isn't running (yet, or anymore).
+                pass
+            self.thread.join()
 
-    def _main_start(self):
-        """Thread for receiving broadcasts."""
+    def _run(self):
+        """Network thread: every connection lives in a single event loop."""
         try:
-            asyncio.run(self._main())
-        except TimeoutError or CancelledError:
-            print("Cannot connect to server. Try again later!")
+            asyncio.run(self._start_main())
+        except (TimeoutError, CancelledError):
+            if self.running:
+                print("Cannot connect to server. Try again later!")
             self.running = False
-        except ConnectionClosedError or IncompleteReadError:
+        except (ConnectionClosedError, IncompleteReadError):
             print("Connection closed.")
             self.running = False
+        finally:
+            self.loop = self.task = self.send_wakeup = None
 
-    def _recv_start(self):
-        """Main Thread, mostly for sending payloads to the server."""
-        try:
-            asyncio.run(self._broadcast())
-        except TimeoutError or CancelledError:
-            print("Cannot connect to server. Try again later!")
-            self.running = False
-        except ConnectionClosedError or IncompleteReadError:
-            print("Connection closed.")
-            self.running = False
+    async def _start_main(self):
+        self.loop = asyncio.get_running_loop()
+        self.send_wakeup = asyncio.Event()
+        self.task = asyncio.current_task()
+        await self._main()
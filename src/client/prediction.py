@@ -0,0 +1,66 @@
+import collections
+import threading
+
+# How many unacknowledged predictions we keep, way more than the inputs in flight (see `MAX_INPUTS_IN_FLIGHT`).
+PREDICTION_HISTORY = 64
+
+
+class Prediction:
+    """
+    Ring buffer of the positions we predicted (and sent to the server) for each numbered "play" event.
+
+    The local player moves right away, as if the server accepted everything. When the server tells us where it
+    has us after event N, the difference with what we predicted for N is the correction to apply: every prediction
+    made after N, and the player itself, get shifted by it, which replays the moves made since N from the
+    server's position. Collisions aren't simulated again, the next frames take care of them.
+
+    The network thread records and confirms, the game loop reconciles: everything goes through a lock.
+    """
+
+    def __init__(self, size=PREDICTION_HISTORY):
+        self.states = collections.deque(maxlen=size)
+        # Latest authoritative state from the server, (seq, level, position), waiting for the game loop.
+        self.confirmed = None
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """Forgets everything, for a new connection."""
+        with self.lock:
+            self.states.clear()
+            self.confirmed = None
+
+    def record(self, seq, level, position):
+        """Remembers the position we predicted for "play" event `seq`."""
+        with self.lock:
+            self.states.append((seq, level, list(position)))
+
+    def confirm(self, seq, level, position):
+        """The server processed every "play" event up to `seq`, and has us at `position`."""
+        with self.lock:
+            if self.confirmed is None or seq > self.confirmed[0]:
+                self.confirmed = (seq, level, list(position))
+
+    def reconcile(self, level):
+        """
+        Returns how much the local player has to be moved by to agree with the server, (0, 0) most of the time.
+
+        `level` is the one the player is on now: corrections about another level don't apply to it.
+        """
+        with self.lock:
+            if self.confirmed is None:
+                return 0, 0
+            seq, confirmed_level, position = self.confirmed
+            self.confirmed = None
+            predicted = None
+            while self.states and self.states[0][0] <= seq:
+                predicted = self.states.popleft()
+            if predicted is None or predicted[0] != seq or predicted[1] != level or level != confirmed_level:
+                # Too old, or from another level: nothing to compare with.
+                return 0, 0
+            dx, dy = position[0] - predicted[2][0], position[1] - predicted[2][1]
+            if dx or dy:
+                for _, later_level, later in self.states:
+                    if later_level == level:
+                        later[0] += dx
+                        later[1] += dy
+            return dx, dy
@@ -576,6 +576,8 @@ class Game:
         self.player = player.Player(self)
         self.tiles = pygame.sprite.LayeredUpdates()
         self.other_players = pygame.sprite.Group()
+        # The same players by nickname, to apply snapshots without looking for each of them.
+        self.other_players_by_nickname = {}
         self.objects = pygame.sprite.LayeredUpdates(self.player)
         self.crashing = False
         self.showing_title = True
@@ -742,6 +744,8 @@ class Game:
 
     def update_objects(self, *args, **kwargs):
         """Updates objects of the game."""
+        # Other players move once per frame, to the latest state the server sent.
+        self.client.sync_players()
         layer1 = self.tiles.get_sprites_from_layer(1)
         layer1_collisions = pygame.sprite.spritecollide(
             self.player, layer1, False, lambda spr1, spr2: spr1.rect.clip(spr2.rect).size >= (2, 2)
@@ -758,6 +762,8 @@ class Game:
             for sprite in layer1:
                 sprite.image.set_alpha(255)
         self.objects.update(*args, **kwargs)
+        # The client sends it to the server when it gets to it.
+        self.client.publish(self.player.rect.topleft, self.level, self.player.direction)
 
     def draw_objects(self, screen):
         """
@@ -866,31 +872,29 @@ class Game:
         tile.image = img.copy()
         tile.tile_type = type
 
-    def add_player(self, nickname, direction, pos=None):
+    def add_player(self, nickname, direction, pos=None, received_at=None):
         """Adds a player that joined the game online."""
         if pos is None:
             pos = [0, 0]
         new_player = player.OtherPlayer(nickname, direction)
         self.other_players.add(new_player)
         self.objects.add(new_player, layer=0)
-        new_player.rect.topleft = tuple(pos)
+        self.other_players_by_nickname[nickname] = new_player
+        new_player.push(pos, direction, received_at)
 
-    def update_player(self, nickname, direction, pos=None):
-        """Update players movement"""
+    def update_player(self, nickname, direction, pos=None, received_at=None):
+        """Update players movement, they are drawn interpolated between their snapshots."""
         if pos is None:
             pos = [0, 0]
-        if not any(other_player for other_player in self.other_players if other_player.nickname == nickname):
+        other_player = self.other_players_by_nickname.get(nickname)
+        if other_player is None:
             raise Exception(f"invalid player : {nickname}")
-        for other_player in self.other_players:
-            if other_player.nickname == nickname:
-                other_player.rect.topleft = tuple(pos)
-                other_player.direction = direction
+        other_player.push(pos, direction, received_at)
 
     def check_who_left(self, active_nicknames):
         """Check who left!"""
-        for ply in self.other_players:
-            if ply.nickname not in active_nicknames:
-                ply.kill()
+        for nickname in self.other_players_by_nickname.keys() - set(active_nicknames):
+            self.other_players_by_nickname.pop(nickname).kill()
 
     @staticmethod
     def render_ean_prompt(screen):
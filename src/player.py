@@ -1,5 +1,8 @@
+import collections
+import itertools
 import os.path as path
 import pathlib
+import time
 
 import pygame
 
@@ -23,6 +26,14 @@ pygame.transform.threshold(
     inverse_set=True,
 )  # if inverse_set were False, all pixels in player_right that were NOT set to a colour of #4A4AFF would be replaced
 other_player_left = pygame.transform.flip(other_player_right, True, False)
+# How far in the past (in seconds) other players are shown: two snapshot intervals, at 20 snapshots per second.
+INTERPOLATION_DELAY = 0.1
+# How long (in seconds) other players keep going on their own when snapshots are late, before coming back.
+MAX_EXTRAPOLATION = 0.05
+# How many snapshots of each other player are kept.
+INTERPOLATION_SAMPLES = 8
+# Moving further than that (in pixels) between two snapshots is a teleport (new level, respawn): no sliding.
+TELEPORT_DISTANCE = 32
 
 
 class Player(pygame.sprite.Sprite):
@@ -76,6 +87,8 @@ class Player(pygame.sprite.Sprite):
 
     def update(self, dt):
         """Auto-update the player"""
+        # Go where the server has us, if it didn't accept some of our moves.
+        self.rect.move_ip(*self.game.client.prediction.reconcile(self.game.level))
         if self.direction == "r":
             self.image = player_right
         else:
@@ -207,7 +220,12 @@ class Player(pygame.sprite.Sprite):
 
 
 class OtherPlayer(pygame.sprite.Sprite):
-    """Another player, using another session."""
+    """
+    Another player, using another session.
+
+    It is shown `INTERPOLATION_DELAY` seconds in the past, moving smoothly between the snapshots received
+    around that time, so that it doesn't jump from one snapshot to the next.
+    """
 
     def __init__(self, nickname, direction):
         super().__init__()
@@ -215,9 +233,46 @@ class OtherPlayer(pygame.sprite.Sprite):
         self.image = player_right
         self.direction = direction
         self.rect = self.image.get_rect()
+        # (received at, x, y, direction), oldest first.
+        self.samples = collections.deque(maxlen=INTERPOLATION_SAMPLES)
+
+    def push(self, position, direction, received_at=None):
+        """Adds the state of this player in a snapshot received at `received_at` (`time.monotonic()`)."""
+        if received_at is None:
+            received_at = time.monotonic()
+        if self.samples and received_at <= self.samples[-1][0]:
+            return
+        self.samples.append((received_at, position[0], position[1], direction))
+        if len(self.samples) == 1:
+            self.rect.topleft = tuple(position)
+            self.direction = direction
+
+    def interpolate(self, at):
+        """Returns where this player was at a given time (`time.monotonic()`), and where it was facing."""
+        samples = self.samples
+        if len(samples) == 1 or at <= samples[0][0]:
+            return samples[0][1:3], samples[0][3]
+        for before, after in zip(samples, itertools.islice(samples, 1, None)):
+            if at < after[0]:
+                break
+        else:
+            # Snapshots are late: keep going the same way for a bit, then come back to the last known position.
+            # Nothing is sent about players who don't move, so they may well have stopped there.
+            late = at - after[0]
+            at = after[0] + max(0.0, min(late, 2 * MAX_EXTRAPOLATION - late))
+        t0, x0, y0, direction = before
+        t1, x1, y1, _ = after
+        if at >= t1:
+            direction = after[3]
+        if abs(x1 - x0) > TELEPORT_DISTANCE or abs(y1 - y0) > TELEPORT_DISTANCE:
+            return ((x1, y1) if at >= t1 else (x0, y0)), direction
+        ratio = (at - t0) / (t1 - t0)
+        return (round(x0 + (x1 - x0) * ratio), round(y0 + (y1 - y0) * ratio)), direction
 
     def update(self, *args, **kwargs):
         """Updates image of player depending on its facing direction"""
+        if self.samples:
+            self.rect.topleft, self.direction = self.interpolate(time.monotonic() - INTERPOLATION_DELAY)
         if self.direction == "r":
             self.image = other_player_right
         else:
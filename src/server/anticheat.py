@@ -1,4 +1,23 @@
 import logging
+import time
+
+import levels
+import metrics
+
+# Fastest a player can move, in pixels per second: one pixel per frame at 60 FPS when walking,
+# and 6 pixels every 18ms at the start of a jump or at full falling speed (see `Player.update`).
+MAX_SPEED_X = 60
+MAX_SPEED_Y = 6 / 0.018
+# Leeway for network jitter and frame rate hiccups, in pixels. It is a budget, not a bonus per move:
+# going faster than allowed uses it up, and only moving slower than allowed gives it back.
+MOVE_SLACK = 16
+# How many rejected moves (not forgiven by accepted ones) a player gets away with before being banned.
+MAX_VIOLATIONS = 50
+# Clients send at most this many play events per second (see `SEND_RATE` in client.py).
+MAX_SEND_RATE = 20
+# How far (in seconds) the time a client's sequence numbers account for can get ahead of the server's clock:
+# a whole window of inputs in flight (see `MAX_INPUTS_IN_FLIGHT` in client.py) may arrive at once.
+MAX_CLOCK_LEAD = 0.5
 
 
 class GameAntiCheat:
@@ -30,6 +49,10 @@ class GameAntiCheat:
             logging.info("Invalid direction.")
             return True
 
+        if not isinstance(event.get("seq"), int):
+            logging.info("Missing sequence number.")
+            return True
+
         if event["position"][0] < 0 or event["position"][1] < 0:
             logging.info("Invalid position [negative].")
             return True
@@ -48,4 +71,55 @@ class GameAntiCheat:
             logging.info("Nickname not in game.")
             return True
 
+        if player.violations >= MAX_VIOLATIONS:
+            logging.info("Too many invalid moves.")
+            return True
+
         return False
+
+    def check_move(self, event, player):
+        """
+        Checks that a move is physically possible, returns the reason why it isn't (None if it is).
+
+        The position must not be inside a solid tile of its level, and the player can't have gone further than
+        its maximum speed allows since its last accepted move (unless it just changed level or respawned).
+
+        Events sent apart can arrive together on a jittery link, so when a move was sent isn't only taken from
+        when it arrived: numbered events are sent at least `1 / MAX_SEND_RATE` seconds apart.
+        Events coming faster than that for longer than `MAX_CLOCK_LEAD`, or going back in sequence, are rejected.
+        """
+        now = time.monotonic()
+        seq = event.get("seq")
+        sent_at = now
+        if player.moved_at is not None and isinstance(seq, int) and isinstance(player.moved_seq, int):
+            sent_at = max(now, player.moved_at + (seq - player.moved_seq) / MAX_SEND_RATE)
+            if seq <= player.moved_seq or sent_at > now + MAX_CLOCK_LEAD:
+                return self._reject(player, "rate")
+        x, y = event["position"]
+        level_map = levels.find_level(event["level"])
+        if level_map is not None:
+            # The player's sprite is 16x16 and its mask narrower, so only its center can't be in a solid tile.
+            if level_map.solid_at(x + levels.TILE_SIZE // 2, y + levels.TILE_SIZE // 2):
+                return self._reject(player, "solid")
+        slack = (MOVE_SLACK, MOVE_SLACK)
+        if player.moved_at is not None and event["level"] == player.level:
+            if level_map is None or (x, y) != level_map.spawn:
+                elapsed = sent_at - player.moved_at
+                old_x, old_y = player.position
+                budget_x = player.move_slack[0] + MAX_SPEED_X * elapsed
+                budget_y = player.move_slack[1] + MAX_SPEED_Y * elapsed
+                if abs(x - old_x) > budget_x or abs(y - old_y) > budget_y:
+                    return self._reject(player, "speed")
+                slack = (min(MOVE_SLACK, budget_x - abs(x - old_x)), min(MOVE_SLACK, budget_y - abs(y - old_y)))
+        player.move_slack = slack
+        player.moved_at = sent_at
+        player.moved_seq = seq
+        if player.violations:
+            player.violations -= 1
+        return None
+
+    @staticmethod
+    def _reject(player, reason):
+        player.violations += 1
+        metrics.rejected_moves.inc(reason)
+        return reason
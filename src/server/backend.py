@@ -1,16 +1,22 @@
+import argparse
 import asyncio
-import json
 import logging
 import os.path as path
 import pathlib
 import ssl
 import time
 
+import metrics
+import protocol
+import snapshot
 import websockets
 from anticheat import GameAntiCheat
 from database import GameDatabase
+from heartbeat import Heartbeat
 from instances import GameManager, PlayerSession
-from manager import ConnectionManager
+from manager import ConnectionManager, SessionRegistry
+from progress import ProgressCache
+from workers import WorkerRouter
 
 
 def _resource_path(file: str):
@@ -23,11 +29,80 @@ ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
 ssl_context.load_cert_chain(_resource_path("server-cert.pem"), keyfile=_resource_path("server-key.pem"))
 logging.basicConfig(format="%(asctime)s - %(filename)s - %(message)s", level=logging.INFO)
 
-games = GameManager()
+# How many snapshots per second each game sends, whatever the rate of incoming moves.
+TICK_RATE = 20
+# Only send players the other players inside their camera area, instead of their whole level.
+VIEWPORT_FILTER = False
+# How many players fit in a game.
+ROOM_CAPACITY = 5
+# Default local-only port of the metrics endpoint (each worker adds its index to it), 0 to disable it.
+METRICS_PORT = 9100
+# How often (in seconds) clients are pinged, and how long they have to answer before being disconnected.
+PING_INTERVAL = 0.5
+PING_TIMEOUT = 10
+# Types of the messages clients send, anything else is counted as "other" in the metrics.
+CLIENT_MESSAGES = ("init", "ready", "broadcast", "play", "ack", "exit")
+
+games = GameManager(TICK_RATE, VIEWPORT_FILTER, ROOM_CAPACITY)
 manager = ConnectionManager()
 db = GameDatabase()
+# Players only hit the database when they are not in this cache.
+progress = ProgressCache(db)
 anticheat = GameAntiCheat()
-players = set()
+# Pings every broadcast (or multiplexed) socket, from a single task.
+heartbeat = Heartbeat(PING_INTERVAL, PING_TIMEOUT)
+sessions = SessionRegistry()
+# Replaced in each worker process when running with several workers.
+router = WorkerRouter()
+
+
+def decode(message):
+    """Decodes a message from a client, recording it in the metrics."""
+    wire = protocol.BINARY if isinstance(message, bytes) else protocol.JSON
+    with metrics.decode_seconds.time(wire):
+        event = protocol.decode(message)
+    # The type comes from the client: a label per unknown type would let anyone create as many series as they want.
+    event_type = event["type"] if event["type"] in CLIENT_MESSAGES else "other"
+    metrics.messages_in.inc(event_type)
+    metrics.bytes_in.inc(event_type, amount=len(message))
+    return event
+
+
+def encode(event, wire):
+    """Encodes a message for a client, recording it in the metrics."""
+    with metrics.encode_seconds.time(wire):
+        message = protocol.encode(event, wire)
+    metrics.messages_out.inc(event["type"])
+    metrics.bytes_out.inc(event["type"], amount=len(message))
+    return message
+
+
+def _players_per_level():
+    players_per_level = {}
+    for game in games:
+        for level, subscribers in game.levels.items():
+            players_per_level[(level,)] = players_per_level.get((level,), 0) + len(subscribers)
+    return players_per_level
+
+
+def _outbox_stats():
+    outboxes = [p.outbox for p in sessions if p.outbox is not None]
+    return {
+        ("lag_max",): max((outbox.lag for outbox in outboxes), default=0.0),
+        ("dropped",): sum(outbox.dropped for outbox in outboxes),
+    }
+
+
+metrics.Gauge("orcs_rooms", "Active games.", callback=lambda: {(): len(games.active_games)})
+metrics.Gauge("orcs_heartbeat_sockets", "Sockets being pinged.", callback=lambda: {(): len(heartbeat)})
+metrics.Gauge("orcs_players", "Players in a game, by level.", ("level",), callback=_players_per_level)
+metrics.Gauge("orcs_outboxes", "Broadcast outboxes (max lag in seconds, dropped messages).", ("stat",), _outbox_stats)
+metrics.Gauge(
+    "orcs_progress_cache",
+    "Progress cache counters.",
+    ("stat",),
+    callback=lambda: {(key,): value for key, value in progress.stats().items()},
+)
 
 
 async def error(websocket, message):
@@ -36,13 +111,15 @@ async def error(websocket, message):
         "type": "error",
         "message": message,
     }
-    await websocket.send(json.dumps(event))
+    await websocket.send(encode(event, protocol.JSON))
 
 
 async def new_game(player):
     """Handles a connection from the first player: start a new game."""
     game = await games.create()  # Initialize a game
-    await game.add_player(player)
+    game.start(broadcast_update)
+    await games.add_player(game, player)
+    await send_initial_snapshot(player)
 
     # Receive and process moves from the first player.
     await play_game(player, game)
@@ -51,40 +128,109 @@ async def new_game(player):
 async def join_game(player):
     """Handle connections from other players, joining an existing game."""
     # Find the game.
-    joined = False
-    for game in games.active_games:
-        if len(game.players) <= 4:
-            try:
-                await game.add_player(player)
-                await asyncio.sleep(1)
-                await broadcast_update(game)
-                joined = True
-                await play_game(player, game)
-            except KeyError as e:
-                logging.info(e)
-                continue
-    if not joined:
+    game = games.find(player)
+    if game is None:
+        # Every game is full.
+        logging.info("Creating New Game!")
         await new_game(player)
+        return
+    await games.add_player(game, player)
+    await send_initial_snapshot(player)
+    await play_game(player, game)
+
+
+def level_snapshot(game, level):
+    """Returns the state of every player on a level (player id => state)."""
+    return {p.id: p.state() for p in game.subscribers(level) if not p.banned}
 
 
-async def ping_pong(websocket):
-    """Trying to keep broadcast alive."""
-    while websocket in manager.active_broadcasts:
-        t0 = time.perf_counter()
-        pong_waiter = await websocket.ping()
-        await pong_waiter
-        t1 = time.perf_counter()
-        latency = f"{t1-t0:.2f}"
-        message = json.dumps({"type": "ping", "latency": latency})
-        await websocket.send(message)
-        await asyncio.sleep(0.5)
+def player_snapshot(game, player, level_view):
+    """Returns the part of a level snapshot a player is interested in."""
+    if not game.viewport_filter:
+        return level_view
+    return {
+        other.id: level_view[other.id]
+        for other in game.subscribers(player.level)
+        if other.id in level_view and player.can_see(other)
+    }
 
 
-async def broadcast_update(game):
-    """Send an "update" event to everyone in the current game."""
-    event = {"type": "update", "game_id": game.id, "players": [p.data() for p in game.players if not p.banned]}
-    players = [p.broadcast for p in game.iter_players() if p.broadcast is not None]
-    websockets.broadcast(players, json.dumps(event))
+async def send_initial_snapshot(player):
+    """
+    Send a full snapshot of its level to a player that just joined a game.
+
+    This is done as soon as both its game and its broadcast socket are known, whichever comes last,
+    so that the player doesn't have to wait for something to move to see the others.
+    The others will see the newcomer in the delta of the next tick.
+    """
+    game = player.game
+    if game is None or player.broadcast is None:
+        return
+    seq = game.next_seq()
+    view = player_snapshot(game, player, level_snapshot(game, player.level))
+    player.remember(seq, view)
+    with metrics.encode_seconds.time(player.protocol):
+        message = snapshot.encode(game.id, seq, None, None, view, game.sessions, player.protocol)
+    metrics.messages_out.inc("update")
+    metrics.bytes_out.inc("update", amount=len(message))
+    player.outbox.put_snapshot(message)
+
+
+async def broadcast_update(game, levels):
+    """
+    Send one "update" event to everyone on the given levels of the game.
+
+    This is called by the game's tick loop, so all the moves received since the last tick are folded in it.
+    Each player only gets what changed since the last snapshot it acknowledged (or a full one if there is none).
+    Snapshots go through each player's outbox, so a slow client only gets the latest one.
+    Players whose `play` events were processed since the last tick get the acknowledgement along their snapshot,
+    or on its own if they have no snapshot to receive.
+    """
+    t0 = time.perf_counter()
+    fanout = 0
+    seq = game.next_seq()
+    unacked, game.unacked = game.unacked, set()
+    # Players acknowledging the same snapshot of the same view with the same protocol get the same message,
+    # so it is only serialized once.
+    # The baseline object itself is part of the key: a player who just changed level acknowledged a snapshot
+    # of its previous level, which is not what the others acknowledging that sequence number have.
+    messages = {}
+    for level in levels:
+        subscribers = game.subscribers(level)
+        level_view = level_snapshot(game, level)
+        for p in subscribers:
+            if p.broadcast is None:
+                continue
+            view = player_snapshot(game, p, level_view)
+            baseline = p.baseline()
+            acked = p.acked if baseline is not None else None
+            key = (level, p.protocol, acked, id(baseline), p.id if game.viewport_filter else None)
+            if key not in messages:
+                with metrics.encode_seconds.time(p.protocol):
+                    messages[key] = snapshot.encode(game.id, seq, acked, baseline, view, game.sessions, p.protocol)
+            if messages[key] is None:
+                # Nothing changed for this player, don't send anything.
+                continue
+            # Its latency and input acknowledgement ride along, instead of being sent on their own.
+            # A snapshot still waiting in the outbox is about to be replaced by this one, and what it carried
+            # with it: the latest values go again, or a client waiting for room to send would wait forever.
+            replacing = p.outbox.snapshot is not None
+            ack = p.input_seq if p in unacked or replacing else None
+            latency = p.pop_rtt()
+            if replacing and latency is None:
+                latency = p.rtt
+            unacked.discard(p)
+            message = protocol.annotate(messages[key], p.protocol, latency=latency, ack=ack)
+            p.outbox.put_snapshot(message)
+            p.remember(seq, view)
+            fanout += 1
+            metrics.bytes_out.inc("update", amount=len(message))
+    for p in unacked:
+        if p.outbox is not None:
+            p.outbox.put(encode({"type": "inputs", "ack": p.input_seq}, p.protocol))
+    metrics.messages_out.inc("update", amount=fanout)
+    metrics.fanout_size.observe(fanout)
+    metrics.fanout_seconds.observe(time.perf_counter() - t0)
 
 
 async def play_game(player, game):
@@ -92,58 +238,68 @@ async def play_game(player, game):
     logging.info(f"Player {player.nickname} joined a game.")
     async for message in player.websocket:
         # Parse a "play" event from the client.
-        event = json.loads(message)
+        event = decode(message)
+        if isinstance(message, bytes):
+            # Binary events don't repeat who sent them, the socket already tells us.
+            event["unique_id"] = player.unique_id
+            event["nickname"] = player.nickname
         if event["type"] == "play":
 
-            # So before echoing back the payload and
+            # So before acknowledging the payload and
             # actually update the logical PlayerSession, anticheat will check the event.
-            player.banned = await anticheat.ensure(event, player, game)
+            with metrics.anticheat_seconds.time():
+                player.banned = await anticheat.ensure(event, player, game)
+                rejected = None if player.banned else anticheat.check_move(event, player)
             if player.banned:
                 logging.info(f"Player {player.nickname} got banned.")
-                await close_broadcast(player.broadcast, event)
+                if player.broadcast not in (None, player.websocket):
+                    await player.broadcast.close()
                 break
 
-            # Echo the payload back to let client know we got it.
-            await player.websocket.send(json.dumps(event))
-
-            # Now that we trust the event, we update the server from the event
-            player.position = event["position"]
-            player.level = event["level"]
-            player.direction = event["direction"]
-            request_id = event["unique_id"]
-
-            event = {"type": "update", "game_id": game.id, "players": [p.data() for p in game.players]}
-            # Send the "update" event to everyone in the current level but exclude the current player!
-            other_players = [
-                p.broadcast
-                for p in game.iter_players()
-                if p.unique_id != request_id and p.broadcast is not None and p.level == player.level
-            ]
-            websockets.broadcast(other_players, json.dumps(event))
+            # The next tick lets the client know we got it (and everything it sent before).
+            game.acknowledge_input(player, event["seq"])
+
+            # Impossible moves (lag, or cheating) aren't applied nor sent to anyone else.
+            if rejected:
+                logging.debug(f"Rejected move from {player.nickname} ({rejected}).")
+                continue
+
+            # Now that we trust the event, we update the server from the event.
+            # The next tick will send the "update" event to everyone in the current level.
+            game.move(player, event["position"], event["level"], event["direction"])
+        elif event["type"] == "ack":
+            # Only when multiplexed, see `receive_acks` otherwise.
+            player.acknowledge(event["seq"])
         elif event["type"] == "exit":
             logging.info(f"Player {player.nickname} left.")
 
 
+async def receive_acks(player, websocket):
+    """Receive snapshot acknowledgements on a broadcast socket."""
+    async for message in websocket:
+        event = decode(message)
+        if event["type"] == "ack" and player is not None:
+            player.acknowledge(event["seq"])
+
+
 async def close_main(websocket, player):
     """Close main websocket properly."""
     logging.info(f"Closed main socket of => {player.nickname}")
-    manager.active_nicknames.remove(player.nickname)
-    await db.save(player)
+    # The player is gone, nothing has to be sent anymore, even if its broadcast socket isn't closed yet.
+    player.detach_broadcast()
+    manager.release_nickname(player.nickname)
+    sessions.remove(player)
+    await progress.save(player)
     await games.remove_player(player)
-    await games.clear()
     await manager.drop_main(websocket)
 
 
-async def close_broadcast(websocket, event):
+async def close_broadcast(websocket):
     """Close broadcast websocket properly."""
     await manager.drop_broadcast(websocket)
-    try:
-        for play in players:
-            if play.unique_id == event["unique_id"]:
-                players.remove(play)
-                logging.info(f"Closed game broadcast of => {play.nickname}")
-    except RuntimeError:
-        pass
+    player = sessions.detach_broadcast(websocket)
+    if player is not None:
+        logging.info(f"Closed game broadcast of => {player.nickname}")
 
 
 async def handler(websocket):
@@ -162,39 +318,44 @@ async def handler(websocket):
         player = None
         logging.info(f"New WebSocket => {websocket.remote_address}")
         event = await websocket.recv()
-        event = json.loads(event)
+        event = decode(event)
+
+        if event["type"] in ["init", "ready", "broadcast"] and not router.owns(event["unique_id"]):
+            # This player belongs to another worker, along with its game.
+            await websocket.send(encode(router.redirect(event["unique_id"]), protocol.JSON))
+            return
 
         # Check if websocket is main or broadcast.
         if event["type"] in ["init", "ready", "play"]:
             if event["type"] in ["init", "ready"]:
-                event = await manager.update(event)
+                event = await manager.update(event, router.new_unique_id)
                 assert event["unique_id"]
                 await manager.add_main(websocket)
                 # Create new player session
                 player = PlayerSession(websocket, event["unique_id"], event["nickname"])
-                players.add(player)
+                player.protocol = protocol.negotiate(event.get("protocols"))
+                event["protocol"] = player.protocol
+                event["mux"] = bool(event.get("mux"))
+                sessions.add(player)
                 # Load progress of player, if any
-                player.level = await db.load(event["unique_id"])
+                player.level = await progress.load(event["unique_id"])
                 event["level"] = player.level if player.level else 0
-                await websocket.send(json.dumps(event))
+                await websocket.send(encode(event, protocol.JSON))
+                if event["mux"]:
+                    # Updates and pings are sent on this socket too, no second connection needed.
+                    player.attach_broadcast(websocket)
+                    heartbeat.add(websocket, player)
 
-            if not games.active_games:
-                # Start a new game.
-                logging.info("Creating New Game!")
-                await new_game(player)
-            else:
-                logging.info("Player will join an existing game!")
-                await join_game(player)
+            await join_game(player)
 
         elif event["type"] == "broadcast":
             await manager.add_broadcast(websocket)
-            for play in players:
-                if play.unique_id == event["unique_id"]:
-                    if not play.broadcast:
-                        play.attach_broadcast(websocket)
-                    break
-            await websocket.send(json.dumps({"type": "broadcast"}))
-            await ping_pong(websocket)
+            session = sessions.attach_broadcast(event["unique_id"], websocket)
+            await websocket.send(encode({"type": "broadcast"}, protocol.JSON))
+            if session is not None:
+                await send_initial_snapshot(session)
+            heartbeat.add(websocket, session)
+            await receive_acks(session, websocket)
 
     except websockets.exceptions.ConnectionClosedError:
         logging.info("Websocket closed with ConnectionClosedError")
@@ -203,18 +364,63 @@ async def handler(websocket):
         logging.info("Websocket closed with ConnectionClosedOK")
 
     finally:
+        heartbeat.discard(websocket)
         # Drop websocket after figuring out its type
         if websocket in manager.active_broadcasts:
-            await close_broadcast(websocket, event)
+            await close_broadcast(websocket)
         elif websocket in manager.active_connections and player:
             await close_main(websocket, player)
 
 
-async def main():
+async def main(host="0.0.0.0", port=8001, tls=True, metrics_port=METRICS_PORT):
     """Main function that starts the server."""
-    async with websockets.serve(handler, "0.0.0.0", 8001, ssl=ssl_context, ping_interval=None, close_timeout=1):
-        await asyncio.Future()  # run forever
+    # Plain websockets are only meant for local load tests, see `loadtest.py`.
+    options = {"ssl": ssl_context if tls else None, "ping_interval": None, "close_timeout": 1}
+    progress.start()
+    heartbeat.start()
+    games.start()
+    if metrics_port:
+        try:
+            await metrics.serve("127.0.0.1", metrics_port + router.index)
+        except OSError as e:
+            # Metrics are nice to have, not a reason to keep players out.
+            logging.error(f"Metrics not available: {e}")
+    lag_monitor = asyncio.create_task(metrics.monitor_loop_lag())
+    try:
+        if router.count == 1:
+            async with websockets.serve(handler, host, port, **options):
+                await asyncio.Future()  # run forever
+        else:
+            # Every worker shares the public port, and listens on its own port for redirected players.
+            async with websockets.serve(handler, host, port, reuse_port=True, **options):
+                async with websockets.serve(handler, host, router.private_port, **options):
+                    logging.info(f"Worker {router.index} listening on port {router.private_port}")
+                    await asyncio.Future()  # run forever
+    finally:
+        lag_monitor.cancel()
+        heartbeat.stop()
+        games.stop()
+        # Don't lose the progress that is only in memory.
+        await progress.stop()
+        db.close()
+
+
+def run_worker(worker_router, host, tls=True, metrics_port=METRICS_PORT):
+    """Entry point of a worker process."""
+    global router
+    router = worker_router
+    asyncio.run(main(host, router.port, tls, metrics_port))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Old-Fashioned Orcs game server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--workers", type=int, default=1, help="number of server processes sharing the port")
+    parser.add_argument("--no-tls", dest="tls", action="store_false", help="serve plain websockets (load tests)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="local metrics endpoint, 0 disables it")
+    args = parser.parse_args()
+    if args.workers > 1:
+        WorkerRouter(count=args.workers, port=args.port).spawn(run_worker, args.host, args.tls, args.metrics_port)
+    else:
+        asyncio.run(main(args.host, args.port, args.tls, args.metrics_port))
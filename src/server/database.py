@@ -1,52 +1,152 @@
+import asyncio
+import logging
+import queue
 import sqlite3
+import threading
+import time
+
+import metrics
+
+# Maximum number of queued queries written in a single transaction.
+BATCH_SIZE = 64
 
 
 class GameDatabase:
-    """This class handles the save/load of the player's progress in our database."""
+    """
+    This class handles the save/load of the player's progress in our database.
 
-    def __init__(self):
-        self.con = sqlite3.connect("./players.db")
-        self.cur = self.con.cursor()
-        self.cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS players
-            ([unique_id] TEXT, [level] INT)
-            """
-        )
-        self.con.commit()
+    sqlite3 blocks, so every query runs on a dedicated thread owning the connection:
+    the event loop only enqueues work and awaits its result.
+    Queries that pile up while a transaction is being written are grouped in the next one (group commit).
+    """
+
+    def __init__(self, path="./players.db", batch_size=BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="database", daemon=True)
+        self._thread.start()
 
     async def save(self, player):
         """This method saves player's progress using `unique_id`"""
-        self.cur.execute(f"SELECT * FROM players WHERE unique_id = '{player.unique_id}'")
-        list = [list for list in self.cur.fetchall()]
-        if not list and player.level is not None:
-            self.cur.execute("INSERT INTO players (unique_id,level) VALUES (?, ?)", (player.unique_id, player.level))
-            self.con.commit()
-        elif list:
-            # Entry already in database.
-            for i in list:
-                old_level = int(i[1])
-            if old_level < player.level:
-                self.cur.execute(f"DELETE FROM players WHERE unique_id IN ('{player.unique_id}')")
-                self.cur.execute(
-                    "INSERT INTO players (unique_id,level) VALUES (?, ?)", (player.unique_id, player.level)
-                )
-                self.con.commit()
+        if player.level is None:
+            return
+        # The session keeps changing, so we only hand its current values to the database thread.
+        await self.save_level(player.unique_id, int(player.level))
+
+    async def save_level(self, unique_id, level):
+        """Saves a level for `unique_id`, if it is better than the one in the database."""
+        await self._submit(self._save, unique_id, level)
 
     async def load(self, unique_id):
         """This method load player's level using `unique_id`"""
-        self.cur.execute(f"SELECT level FROM players WHERE unique_id = '{unique_id}'")
-        list = [list for list in self.cur.fetchall()]
-        for i in list:
-            return i[0]
+        return await self._submit(self._load, unique_id)
 
     async def delete(self, player):
         """This method resets player's level using `unique_id`"""
-        self.cur.execute(f"DELETE FROM players WHERE unique_id IN ('{player.unique_id}')")
-        self.con.commit()
+        await self._submit(self._delete, player.unique_id)
 
     async def show_all(self):
         """Prints everything, for testing only"""
-        self.cur.execute("SELECT * FROM players")
-        list = [list for list in self.cur.fetchall()]
-        return list
+        return await self._submit(self._show_all)
+
+    def close(self):
+        """Writes what is still queued and stops the database thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _submit(self, query, *args):
+        """Queues a query for the database thread, returns a future of its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        t0 = time.perf_counter()
+        name = query.__name__.lstrip("_")
+        future.add_done_callback(lambda _: metrics.db_seconds.observe(time.perf_counter() - t0, name))
+        self._queue.put((query, args, loop, future))
+        return future
+
+    def _run(self):
+        """Database thread: runs queued queries, in batches sharing a single commit."""
+        self.con = sqlite3.connect(self.path)
+        self.cur = self.con.cursor()
+        self._setup()
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                # Shutting down, but what was queued before still gets written.
+                running = False
+                batch = [item for item in batch if item is not None]
+            results = []
+            try:
+                with self.con:
+                    for query, args, loop, future in batch:
+                        try:
+                            results.append((loop, future, query(*args), None))
+                        except sqlite3.Error as e:
+                            results.append((loop, future, None, e))
+            except sqlite3.Error as e:
+                # The commit itself failed, none of the batch was written.
+                logging.exception("Database commit failed.")
+                results = [(loop, future, None, e) for loop, future, _, _ in results]
+            for loop, future, result, exception in results:
+                loop.call_soon_threadsafe(_resolve, future, result, exception)
+        self.con.close()
+
+    def _setup(self):
+        """Creates (or migrates) the table, with `unique_id` as its primary key."""
+        self.cur.execute("PRAGMA journal_mode=WAL")
+        self.cur.execute("PRAGMA synchronous=NORMAL")
+        columns = {row[1]: row[5] for row in self.cur.execute("PRAGMA table_info(players)")}
+        with self.con:
+            if columns and not columns.get("unique_id"):
+                # Old table without a primary key (and possibly duplicates), only keep the best level of each player.
+                self.cur.execute("CREATE TABLE players_new ([unique_id] TEXT PRIMARY KEY, [level] INT)")
+                self.cur.execute(
+                    """
+                    INSERT INTO players_new (unique_id, level)
+                    SELECT unique_id, MAX(level) FROM players GROUP BY unique_id
+                    """
+                )
+                self.cur.execute("DROP TABLE players")
+                self.cur.execute("ALTER TABLE players_new RENAME TO players")
+            else:
+                self.cur.execute("CREATE TABLE IF NOT EXISTS players ([unique_id] TEXT PRIMARY KEY, [level] INT)")
+
+    # The queries below only run on the database thread.
+    # They always use the same SQL strings, so sqlite3 reuses their prepared statements.
+
+    def _save(self, unique_id, level):
+        # Progress is only ever saved if the player went further.
+        self.cur.execute(
+            """
+            INSERT INTO players (unique_id, level) VALUES (?, ?)
+            ON CONFLICT(unique_id) DO UPDATE SET level = excluded.level WHERE excluded.level > players.level
+            """,
+            (unique_id, level),
+        )
+
+    def _load(self, unique_id):
+        row = self.cur.execute("SELECT level FROM players WHERE unique_id = ?", (unique_id,)).fetchone()
+        return row[0] if row else None
+
+    def _delete(self, unique_id):
+        self.cur.execute("DELETE FROM players WHERE unique_id = ?", (unique_id,))
+
+    def _show_all(self):
+        return self.cur.execute("SELECT * FROM players").fetchall()
+
+
+def _resolve(future, result, exception):
+    """Sets the result of a query, on the event loop that is waiting for it."""
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
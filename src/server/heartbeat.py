@@ -0,0 +1,110 @@
+import asyncio
+import functools
+import itertools
+import logging
+import time
+
+import metrics
+import websockets
+
+# How often (in seconds) each socket gets pinged.
+PING_INTERVAL = 0.5
+# How long (in seconds) a ping can stay unanswered before the socket is considered dead.
+PING_TIMEOUT = 10
+# Slots of the timer wheel: sockets are pinged in this many batches per interval.
+SLOTS = 10
+
+
+class Heartbeat:
+    """
+    Pings every registered socket from a single task, instead of a task per socket.
+
+    Sockets are spread over the slots of a timer wheel, which moves to its next slot every `interval / slots`
+    seconds and pings the whole slot at once: each socket is pinged once per `interval`, in small batches.
+    The round trip time is recorded in the player's session, to be piggybacked on its next snapshot,
+    and sockets that didn't answer their last ping within `timeout` seconds are closed.
+    """
+
+    def __init__(self, interval=PING_INTERVAL, timeout=PING_TIMEOUT, slots=SLOTS):
+        self.interval = interval
+        self.timeout = timeout
+        # Each slot maps its sockets to their player session (None if we don't know it).
+        self.slots = [{} for _ in range(slots)]
+        self._slot_of = {}
+        self._next_slot = itertools.cycle(range(slots))
+        # Sockets waiting for a pong => when the ping was sent.
+        self._pending = {}
+        self._task = None
+
+    def start(self):
+        """Starts turning the wheel."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """Stops pinging."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def add(self, websocket, player=None):
+        """Starts pinging a socket."""
+        slot = next(self._next_slot)
+        self.slots[slot][websocket] = player
+        self._slot_of[websocket] = slot
+
+    def discard(self, websocket):
+        """Stops pinging a socket, if it was pinged."""
+        slot = self._slot_of.pop(websocket, None)
+        if slot is not None:
+            del self.slots[slot][websocket]
+        self._pending.pop(websocket, None)
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    async def _run(self):
+        step = self.interval / len(self.slots)
+        for slot in itertools.cycle(self.slots):
+            await asyncio.sleep(step)
+            if slot:
+                try:
+                    await self._sweep(list(slot.items()), step)
+                except Exception:
+                    logging.exception("Heartbeat sweep failed.")
+
+    async def _sweep(self, batch, step):
+        now = time.perf_counter()
+        pings = []
+        for websocket, player in batch:
+            sent_at = self._pending.get(websocket)
+            if sent_at is None:
+                pings.append(self._ping(websocket, player))
+            elif now - sent_at > self.timeout:
+                logging.info(f"No pong from {websocket.remote_address} for {now - sent_at:.1f}s, closing.")
+                metrics.dead_peers.inc()
+                self.discard(websocket)
+                websocket.fail_connection(1011, "keepalive ping timeout")
+            # Otherwise its last ping is still on its way, no need to pile up another one.
+        if pings:
+            # Sending a ping waits if the socket's write buffer is full: don't let a slow client hold the wheel.
+            await asyncio.wait([asyncio.ensure_future(ping) for ping in pings], timeout=step)
+
+    async def _ping(self, websocket, player):
+        self._pending[websocket] = t0 = time.perf_counter()
+        try:
+            pong_waiter = await websocket.ping()
+        except websockets.exceptions.ConnectionClosed:
+            self.discard(websocket)
+            return
+        pong_waiter.add_done_callback(functools.partial(self._pong, websocket, player, t0))
+
+    def _pong(self, websocket, player, t0, pong_waiter):
+        if pong_waiter.cancelled() or pong_waiter.exception() is not None:
+            return
+        rtt = time.perf_counter() - t0
+        if self._pending.get(websocket) == t0:
+            del self._pending[websocket]
+        metrics.ping_rtt_seconds.observe(rtt)
+        if player is not None:
+            player.record_rtt(rtt)
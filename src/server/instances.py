@@ -1,6 +1,29 @@
+import asyncio
+import itertools
 import logging
+import time
 import uuid
 
+import protocol
+from outbox import Outbox
+
+# Default number of snapshots a game sends per second.
+TICK_RATE = 20
+# How many sent snapshots a session keeps around to be used as a delta baseline.
+SNAPSHOT_HISTORY = 32
+# Size of the game's camera (see `Camera` in game.py), used to only send players a client can actually see.
+VIEWPORT = (160, 144)
+# Extra room around the viewport, so that players don't pop in right at the edge of the screen.
+VIEWPORT_MARGIN = 16
+# Default number of players a game can hold.
+ROOM_CAPACITY = 5
+# How long (in seconds) an empty game is kept around, ready for players to join it again.
+ROOM_GRACE = 30
+# How often (in seconds) empty games are looked for.
+SWEEP_INTERVAL = 5
+
+_player_ids = itertools.count(1)
+
 
 class PlayerSession:
     """Logical Player to keep track of its data"""
@@ -8,45 +31,270 @@ class PlayerSession:
     def __init__(self, websocket, unique_id, nickname):
         self.websocket = websocket
         self.broadcast = None
+        # Bounded queue of what is waiting to be sent on the broadcast socket.
+        self.outbox = None
+        self.game = None
+        # Short public id, so that snapshots don't have to repeat the nickname.
+        self.id = next(_player_ids)
         self.unique_id = unique_id
         self.nickname = nickname
         self.banned = None
+        # Moves rejected by the anticheat (each accepted move forgives one), when the last accepted one was sent
+        # (monotonic clock) along with its sequence number, and the slack left on each axis, see `check_move`.
         self.violations = 0
-        self.level = -1
-        self.position = [0, 0]
-        self.direction = "r"
+        self.moved_at = None
+        self.moved_seq = None
+        self.move_slack = None
+        # Serialized public data by protocol, and its immutable copy, cleared when the player changes.
+        self._fragments = {}
+        self._state = None
+        self._level = -1
+        self._position = [0, 0]
+        self._direction = "r"
+        # Wire protocol negotiated during the hello.
+        self.protocol = protocol.JSON
+        # Snapshots sent on the broadcast socket by sequence number, and the last one the client acknowledged.
+        self.snapshots = {}
+        self.acked = None
+        # Sequence number of the last "play" event processed, acknowledged on the next tick.
+        self.input_seq = None
+        # Round trip time of the last heartbeat ping (seconds), and whether the client was told about it.
+        self.rtt = None
+        self._rtt_sent = True
 
     def data(self):
         """Returns all public data for a Player (position, nickname, level)"""
-        return {"nickname": self.nickname, "position": self.position, "level": self.level, "direction": self.direction}
+        return {
+            "id": self.id,
+            "nickname": self.nickname,
+            "position": self.position,
+            "level": self.level,
+            "direction": self.direction,
+        }
+
+    @property
+    def level(self):
+        """Number of the level the player is on."""
+        return self._level
+
+    @level.setter
+    def level(self, value):
+        self._level = value
+        self._changed()
+
+    @property
+    def position(self):
+        """Position of the player (top left corner, in pixels)."""
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self._position = value
+        self._changed()
+
+    @property
+    def direction(self):
+        """Where the player is facing, "r" or "l"."""
+        return self._direction
+
+    @direction.setter
+    def direction(self, value):
+        self._direction = value
+        self._changed()
+
+    def _changed(self):
+        self._fragments.clear()
+        self._state = None
+
+    def state(self):
+        """Returns an immutable copy of the public data, used to diff snapshots."""
+        if self._state is None:
+            self._state = (self.nickname, tuple(self.position), self.level, self.direction)
+        return self._state
+
+    def fragment(self, wire):
+        """Returns the public data serialized for a snapshot, only serialized again after a change."""
+        fragment = self._fragments.get(wire)
+        if fragment is None:
+            fragment = self._fragments[wire] = protocol.encode_entry(self.data(), wire)
+        return fragment
 
     def attach_broadcast(self, websocket):
         """Adds second websocket in Player"""
         self.broadcast = websocket
+        self.outbox = Outbox(websocket)
+        # A new socket means a new client state, so the next snapshot has to be a full one.
+        self.snapshots = {}
+        self.acked = None
+
+    def detach_broadcast(self):
+        """Stops sending on the broadcast socket, which is closing."""
+        if self.outbox is not None:
+            self.outbox.close()
+        self.broadcast = None
+        self.outbox = None
+
+    def record_rtt(self, rtt):
+        """Keeps a measured round trip time, it will be sent along the next snapshot."""
+        self.rtt = rtt
+        self._rtt_sent = False
+
+    def pop_rtt(self):
+        """Returns the round trip time the client wasn't told about yet, None if there is none."""
+        if self._rtt_sent:
+            return None
+        self._rtt_sent = True
+        return self.rtt
+
+    def remember(self, seq, view):
+        """Keeps a sent snapshot so that it can be used as a baseline once acknowledged."""
+        self.snapshots[seq] = view
+        if len(self.snapshots) > SNAPSHOT_HISTORY:
+            del self.snapshots[next(iter(self.snapshots))]
+
+    def acknowledge(self, seq):
+        """The client received snapshot `seq`, older ones will never be used as a baseline again."""
+        if seq not in self.snapshots or (self.acked is not None and seq <= self.acked):
+            return
+        self.acked = seq
+        for old in [old for old in self.snapshots if old < seq]:
+            del self.snapshots[old]
+
+    def baseline(self):
+        """Returns the last snapshot the client acknowledged, None if it has to get a full one."""
+        if self.acked is None:
+            return None
+        return self.snapshots.get(self.acked)
+
+    def can_see(self, other):
+        """Checks if another player is inside (or close to) the camera area around this player."""
+        width, height = VIEWPORT
+        return (
+            abs(other.position[0] - self.position[0]) <= width // 2 + VIEWPORT_MARGIN
+            and abs(other.position[1] - self.position[1]) <= height // 2 + VIEWPORT_MARGIN
+        )
 
 
 class GameInstance:
     """Logical Game Instance"""
 
-    def __init__(self, game_id):
+    def __init__(self, game_id, tick_rate=TICK_RATE, viewport_filter=False):
         self.id = game_id
         self.players = []
-        self.sockets = []
-        self.nicknames = []
+        self.sockets = set()
+        self.nicknames = set()
+        # Players by their public id.
+        self.sessions = {}
+        # Players subscribed to each level, only them get the snapshots of that level.
+        self.levels = {}
+        self.tick_rate = tick_rate
+        # If enabled, players only get the other players that are inside their camera area.
+        self.viewport_filter = viewport_filter
+        self.seq = 0
+        # Levels that changed since the last tick, folded into a single snapshot.
+        self.dirty_levels = set()
+        # Players whose "play" events have to be acknowledged on the next tick.
+        self.unacked = set()
+        self.tick_task = None
+        # When the last player left (monotonic clock), None while someone is playing.
+        self.empty_since = time.monotonic()
+
+    def touch(self, level):
+        """Flags a level so that its players receive a snapshot on the next tick."""
+        self.dirty_levels.add(level)
+
+    def acknowledge_input(self, player, seq):
+        """Flags a player's "play" event as processed, the next tick acknowledges it (and the ones before)."""
+        player.input_seq = seq
+        self.unacked.add(player)
+
+    def subscribers(self, level):
+        """Returns the players currently on a level."""
+        return self.levels.get(level, ())
+
+    def move(self, player, position, level, direction):
+        """Updates a player from a trusted "play" event and flags what needs to be sent on the next tick."""
+        if player.level != level:
+            self._unsubscribe(player)
+            player.level = level
+            self._subscribe(player)
+        player.position = position
+        player.direction = direction
+        self.touch(level)
+
+    def _subscribe(self, player):
+        self.levels.setdefault(player.level, set()).add(player)
+        self.touch(player.level)
+
+    def _unsubscribe(self, player):
+        subscribers = self.levels.get(player.level)
+        if subscribers is not None:
+            subscribers.discard(player)
+            if not subscribers:
+                del self.levels[player.level]
+        # Players on the level we are leaving need to know too.
+        self.touch(player.level)
+
+    def next_seq(self):
+        """Returns the sequence number of the next snapshot."""
+        self.seq += 1
+        return self.seq
+
+    def start(self, on_tick):
+        """Starts the fixed-rate tick loop of this game."""
+        if self.tick_task is None:
+            self.tick_task = asyncio.create_task(self._tick_loop(on_tick))
+
+    def stop(self):
+        """Stops the tick loop of this game."""
+        if self.tick_task is not None:
+            self.tick_task.cancel()
+            self.tick_task = None
+
+    async def _tick_loop(self, on_tick):
+        """Calls `on_tick` at most `tick_rate` times per second, only when something changed or needs an ack."""
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.tick_rate
+        next_tick = loop.time()
+        while True:
+            next_tick += interval
+            delay = next_tick - loop.time()
+            if delay < 0:
+                # We are late (the loop was busy), skip the missed ticks instead of bursting.
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+            if not self.dirty_levels and not self.unacked:
+                continue
+            levels, self.dirty_levels = self.dirty_levels, set()
+            try:
+                await on_tick(self, levels)
+            except Exception:
+                logging.exception(f"Tick failed for game {self.id}")
 
     async def add_player(self, player):
         """Add a player to an existing game"""
         if player.nickname in self.nicknames:
             raise KeyError("Nickname in use")
-        self.nicknames.append(player.nickname)
+        self.nicknames.add(player.nickname)
         self.players.append(player)
-        self.sockets.append(player.websocket)
+        self.sessions[player.id] = player
+        player.game = self
+        self.sockets.add(player.websocket)
+        self.empty_since = None
+        self._subscribe(player)
 
     async def remove_player(self, player):
         """Remove player from an existing game"""
         self.nicknames.remove(player.nickname)
         self.players.remove(player)
+        del self.sessions[player.id]
+        player.game = None
         self.sockets.remove(player.websocket)
+        self._unsubscribe(player)
+        self.unacked.discard(player)
+        if not self.players:
+            self.empty_since = time.monotonic()
 
     def iter_players(self):
         """Returns a list of players"""
@@ -60,42 +308,111 @@ class GameInstance:
 class GameManager:
     """It handles ALL logical game instances to enable multiplayer and keep track of players."""
 
-    def __init__(self):
-        self.active_games = []
+    def __init__(self, tick_rate=TICK_RATE, viewport_filter=False, capacity=ROOM_CAPACITY, grace=ROOM_GRACE):
+        # Game id => game.
+        self.active_games = {}
+        self.tick_rate = tick_rate
+        self.viewport_filter = viewport_filter
+        self.capacity = capacity
+        self.grace = grace
+        # Games with free slots, bucketed by number of free slots (game id => game).
+        # The last bucket holds the empty games, waiting to be reused or reaped.
+        self.open_games = {free: {} for free in range(1, capacity + 1)}
+        self.sweeper = None
+
+    def start(self):
+        """Starts reaping the games that stay empty."""
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self._sweep_loop())
+
+    def stop(self):
+        """Stops reaping empty games, and every game's tick loop."""
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+        for game in self.active_games.values():
+            game.stop()
 
     async def create(self):
         """Creates a logical new game."""
         game_id = uuid.uuid4().hex
-        new_game = GameInstance(game_id)
-        self.active_games.append(new_game)
+        new_game = GameInstance(game_id, self.tick_rate, self.viewport_filter)
+        self.active_games[game_id] = new_game
+        self._index(new_game)
         logging.info(f"Created game with id: {new_game.id}")
         return new_game
 
+    def find(self, player):
+        """
+        Finds a game with a free slot and without a player using the same nickname.
+
+        The fullest games are picked first, so that players actually meet each other.
+        Returns None if every game is full.
+        """
+        for free in range(1, self.capacity + 1):
+            for game in self.open_games[free].values():
+                if player.nickname not in game.nicknames:
+                    return game
+        return None
+
+    async def add_player(self, game, player):
+        """Adds a player to a game, keeping the index of open games up to date."""
+        self._unindex(game)
+        try:
+            await game.add_player(player)
+        finally:
+            self._index(game)
+
+    def _index(self, game):
+        free = self.capacity - len(game.players)
+        if free > 0:
+            self.open_games[free][game.id] = game
+
+    def _unindex(self, game):
+        free = self.capacity - len(game.players)
+        if free > 0:
+            self.open_games[free].pop(game.id, None)
+
     async def delete(self, game: GameInstance):
         """Deletes a game if no players in it."""
-        del self.active_games.remove[game]
+        if game.players:
+            return
+        logging.info(f"Deleting empty game with id: {game.id}")
+        game.stop()
+        self._unindex(game)
+        self.active_games.pop(game.id, None)
 
     async def clear(self):
-        """Auto-checks for empty games."""
-        for game in self.active_games:
-            if len(game.players) == 0:
-                logging.info(f"Deleting empty game with id: {game.id}")
-                self.active_games.remove(game)
+        """Deletes the games that have been empty for longer than the grace period."""
+        now = time.monotonic()
+        # Only empty games have every slot free.
+        for game in list(self.open_games[self.capacity].values()):
+            if game.empty_since is not None and now - game.empty_since >= self.grace:
+                await self.delete(game)
 
     async def remove_player(self, player):
         """Remove player from its game"""
-        for game in self.active_games:
-            for local_player in game.players:
-                if player == local_player:
-                    await game.remove_player(player)
-                    from backend import broadcast_update
+        game = player.game
+        if game is None:
+            return
+        # Removing the player flags its level, the next tick tells the others.
+        # An empty game stays open for a while, see `clear`.
+        self._unindex(game)
+        await game.remove_player(player)
+        self._index(game)
 
-                    await broadcast_update(game)
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                await self.clear()
+            except Exception:
+                logging.exception("Failed to reap empty games.")
 
     def __iter__(self):
         """Iterates over active games."""
-        return iter(self.active_games)
+        return iter(list(self.active_games.values()))
 
     def __call__(self):
         """Return a list of all currently active games."""
-        return self.active_games
+        return list(self.active_games.values())
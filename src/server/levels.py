@@ -0,0 +1,133 @@
+"""
+Server side reader of the game's maps (`maps/levelN.tmx`).
+
+The server doesn't have pygame or pytmx, and only needs to know where the solid tiles and the spawn point are,
+so this reads the CSV layers and the tileset's properties with the standard library.
+"""
+import functools
+import os.path as path
+import pathlib
+import xml.etree.ElementTree as ElementTree
+
+MAPS_DIR = pathlib.Path(__file__).resolve().parents[2] / "maps"
+TILE_SIZE = 16
+# Tiles that aren't solid (local ids), see `Game.read_map`.
+NOT_SOLID = {1, 20, 22, 25, 48, 49, 50}
+# Tiled stores the flip flags in the highest bits of the gid.
+_GID_MASK = 0x1FFFFFFF
+# Areas (object names) where switches add or remove tiles, see `SwitchDestroyManager` and `SwitchSpawnManager`.
+DYNAMIC_AREAS = ("destroyer", "spawner")
+
+
+class LevelMap:
+    """Tiles of a level. Layer 0 is the one players collide with."""
+
+    def __init__(self, level, width, height, layers, properties, dynamic_areas=()):
+        self.level = level
+        # Size in tiles.
+        self.width = width
+        self.height = height
+        # layers[layer][y][x] is a local tile id, or None if there is no tile.
+        self.layers = layers
+        # Local tile id => value of its "tile" property (solid, spawnpoint, npc...).
+        self.properties = properties
+        self.spawn = self._find_spawn()
+        # One byte per tile of layer 0, row by row, 1 where players collide.
+        # Tiles in `dynamic_areas` (x, y, width, height in pixels) come and go, so they never count as solid.
+        self.grid = self._occupancy(dynamic_areas)
+
+    @property
+    def pixel_size(self):
+        """Size of the level in pixels."""
+        return self.width * TILE_SIZE, self.height * TILE_SIZE
+
+    def tile(self, x, y, layer=0):
+        """Returns the local id of a tile, None if there is nothing (or if it is outside of the map)."""
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        return self.layers[layer][y][x]
+
+    def is_solid(self, x, y, layer=0):
+        """Checks if a tile blocks players."""
+        tile_id = self.tile(x, y, layer)
+        return tile_id is not None and tile_id not in NOT_SOLID and self.properties.get(tile_id) != "spawnpoint"
+
+    def solid_at(self, x, y):
+        """Checks if a pixel is inside a solid tile of layer 0, using the occupancy grid."""
+        tile_x, tile_y = int(x) // TILE_SIZE, int(y) // TILE_SIZE
+        if not (0 <= tile_x < self.width and 0 <= tile_y < self.height):
+            return False
+        return self.grid[tile_y * self.width + tile_x] == 1
+
+    def _occupancy(self, dynamic_areas):
+        grid = bytearray(self.width * self.height)
+        for y in range(self.height):
+            for x in range(self.width):
+                grid[y * self.width + x] = self.is_solid(x, y)
+        for area_x, area_y, width, height in dynamic_areas:
+            for y in range(max(0, area_y // TILE_SIZE), min(self.height, -(-(area_y + height) // TILE_SIZE))):
+                for x in range(max(0, area_x // TILE_SIZE), min(self.width, -(-(area_x + width) // TILE_SIZE))):
+                    grid[y * self.width + x] = 0
+        return bytes(grid)
+
+    def _find_spawn(self):
+        for layer in self.layers:
+            for y, row in enumerate(layer):
+                for x, tile_id in enumerate(row):
+                    if tile_id is not None and self.properties.get(tile_id) == "spawnpoint":
+                        return x * TILE_SIZE, y * TILE_SIZE
+        return 0, 0
+
+
+@functools.lru_cache(maxsize=None)
+def available_levels():
+    """Returns the numbers of the levels shipped with the game."""
+    levels = []
+    for file in MAPS_DIR.glob("level*.tmx"):
+        number = file.stem.removeprefix("level")
+        if number.isdigit():
+            levels.append(int(number))
+    return tuple(sorted(levels))
+
+
+def find_level(level):
+    """Returns the map of a level, None if there is no such level."""
+    try:
+        level = int(level)
+    except (TypeError, ValueError):
+        return None
+    if level not in available_levels():
+        return None
+    return load_level(level)
+
+
+@functools.lru_cache(maxsize=None)
+def load_level(level):
+    """Reads `maps/level{level}.tmx`, each level is only read once."""
+    file = MAPS_DIR / f"level{level}.tmx"
+    root = ElementTree.parse(file).getroot()
+    tileset = root.find("tileset")
+    first_gid = int(tileset.get("firstgid"))
+    properties = _read_tileset(path.normpath(MAPS_DIR / tileset.get("source")))
+    layers = []
+    for layer in root.iter("layer"):
+        rows = [row for row in layer.find("data").text.strip().splitlines() if row]
+        gids = [[int(gid) & _GID_MASK for gid in row.split(",") if gid] for row in rows]
+        layers.append([[gid - first_gid if gid else None for gid in row] for row in gids])
+    dynamic_areas = [
+        tuple(round(float(area.get(key, 0))) for key in ("x", "y", "width", "height"))
+        for area in root.iter("object")
+        if any(name in area.get("name", "") for name in DYNAMIC_AREAS)
+    ]
+    width, height = int(root.get("width")), int(root.get("height"))
+    return LevelMap(level, width, height, layers, properties, dynamic_areas)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_tileset(file):
+    properties = {}
+    for tile in ElementTree.parse(file).getroot().iter("tile"):
+        for prop in tile.iter("property"):
+            if prop.get("name") == "tile":
+                properties[int(tile.get("id"))] = prop.get("value")
+    return properties
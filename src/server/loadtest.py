@@ -0,0 +1,303 @@
+"""
+Load generator for the game server: a swarm of headless bots.
+
+Bots speak the same protocol as the game (hello, play, acks, broadcast socket or multiplexed connection),
+and walk back and forth on the floor of the shipped maps, jumping from time to time.
+
+Example, against a local server started with `python backend.py --no-tls`:
+
+    python loadtest.py --url ws://127.0.0.1:8001 --bots 1000 --processes 8 --duration 60
+
+Update delivery latency is measured between the moment a bot sends a position and the moment another bot
+gets it in a snapshot, so it only counts bots sharing a process. Games are filled in join order, so each process
+gets contiguous groups of `--room-capacity` bots that join together: most games only hold bots of one process.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import ssl
+import statistics
+import time
+
+import levels
+import protocol
+import websockets
+
+# How fast players walk (one pixel per frame at 60 FPS), in pixels per second.
+WALK_SPEED = 60
+# How many players fit in a game, see `ROOM_CAPACITY` in backend.py.
+ROOM_CAPACITY = 5
+
+
+class Stats:
+    """What a bot process measured."""
+
+    def __init__(self):
+        self.join_latencies = []
+        self.update_latencies = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+
+    def merge(self, other):
+        """Adds what another process measured."""
+        self.join_latencies.extend(other.join_latencies)
+        self.update_latencies.extend(other.update_latencies)
+        self.sent += other.sent
+        self.received += other.received
+        self.errors += other.errors
+
+
+class Walker:
+    """Walks on the floor of a level, turning around at walls and holes."""
+
+    def __init__(self, level_map):
+        self.map = level_map
+        x, y = level_map.spawn
+        self.tile_x = x // levels.TILE_SIZE
+        self.tile_y = y // levels.TILE_SIZE
+        # Fall from the spawn point to the floor.
+        while self.tile_y < level_map.height - 1 and not level_map.is_solid(self.tile_x, self.tile_y + 1):
+            self.tile_y += 1
+        self.x = float(self.tile_x * levels.TILE_SIZE)
+        self.direction = random.choice("rl")
+        self.jump = 0.0
+
+    def step(self, dt):
+        """Moves for `dt` seconds, returns the new position (top left corner, in pixels)."""
+        dx = WALK_SPEED * dt * (1 if self.direction == "r" else -1)
+        next_x = self.x + dx
+        tile_x = int(next_x // levels.TILE_SIZE) + (1 if self.direction == "r" else 0)
+        blocked = self.map.is_solid(tile_x, self.tile_y) or not self.map.is_solid(tile_x, self.tile_y + 1)
+        if blocked or not 0 <= next_x <= (self.map.width - 1) * levels.TILE_SIZE:
+            self.direction = "l" if self.direction == "r" else "r"
+        else:
+            self.x = next_x
+        if self.jump <= 0 and random.random() < dt / 3:
+            self.jump = 0.5
+        height = 0
+        if self.jump > 0:
+            # Simple parabola, up to two tiles high.
+            self.jump = max(0.0, self.jump - dt)
+            height = int(32 * (1 - ((self.jump - 0.25) / 0.25) ** 2))
+        # Players stand one pixel into the floor, see `Player.update`.
+        return [int(self.x), self.tile_y * levels.TILE_SIZE + 1 - height]
+
+
+class Bot:
+    """A scripted client."""
+
+    def __init__(self, index, args, stats, registry):
+        self.nickname = f"Bot{index}"
+        self.args = args
+        self.stats = stats
+        # Bots of this process by nickname, to measure update delivery.
+        self.registry = registry
+        self.level = random.choice(args.levels)
+        self.walker = Walker(levels.load_level(self.level))
+        self.wire = protocol.JSON
+        self.url = args.url
+        self.unique_id = ""
+        # Player id => nickname, learned from full entries.
+        self.nicknames = {}
+        # Recently sent positions => when they were sent.
+        self.sent = {}
+        # Sequence number of the last "play" event sent.
+        self.input_seq = 0
+
+    async def run(self, deadline):
+        """Joins a game and plays until `deadline` (`time.perf_counter()`)."""
+        t0 = time.perf_counter()
+        self.joined = asyncio.get_running_loop().create_future()
+        self.registry[self.nickname] = self
+        main = await self._connect_main()
+        # The connection was opened by hand (see `_connect_main`), so it is closed by hand too.
+        tasks = []
+        try:
+            if self.args.mux:
+                tasks.append(asyncio.create_task(self._listen(main)))
+            else:
+                tasks.append(asyncio.create_task(self._broadcast()))
+                # Errors come on the main socket.
+                tasks.append(asyncio.create_task(self._drain(main)))
+            try:
+                await asyncio.wait_for(asyncio.shield(self.joined), timeout=10)
+                self.stats.join_latencies.append(time.perf_counter() - t0)
+            except asyncio.TimeoutError:
+                self.stats.errors += 1
+            await self._play(main, deadline)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await main.close()
+
+    async def _connect_main(self):
+        while True:
+            websocket = await websockets.connect(self.url, ssl=self.args.ssl, close_timeout=1)
+            hello = {
+                "type": "init",
+                "unique_id": self.unique_id,
+                "nickname": self.nickname,
+                "direction": "r",
+                "protocols": [self.args.protocol],
+                "mux": self.args.mux,
+            }
+            await websocket.send(json.dumps(hello))
+            response = json.loads(await websocket.recv())
+            if response["type"] == "redirect":
+                # Our worker listens on another port.
+                await websocket.close()
+                self.url = _with_port(self.url, response["port"])
+                continue
+            self.unique_id = response["unique_id"]
+            self.nickname = response["nickname"]
+            self.registry[self.nickname] = self
+            self.wire = response.get("protocol", protocol.JSON)
+            return websocket
+
+    async def _broadcast(self):
+        async with websockets.connect(self.url, ssl=self.args.ssl, close_timeout=1) as websocket:
+            await websocket.send(json.dumps({"type": "broadcast", "unique_id": self.unique_id}))
+            await self._listen(websocket)
+
+    async def _drain(self, websocket):
+        try:
+            async for _ in websocket:
+                self.stats.received += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def _listen(self, websocket):
+        try:
+            async for message in websocket:
+                self.stats.received += 1
+                event = protocol.decode(message)
+                if event["type"] != "update":
+                    continue
+                if not self.joined.done():
+                    self.joined.set_result(None)
+                now = time.perf_counter()
+                for player in event["players"]:
+                    if "nickname" in player:
+                        self.nicknames[player["id"]] = player["nickname"]
+                    mover = self.registry.get(self.nicknames.get(player["id"]))
+                    if mover is not None and mover is not self and "position" in player:
+                        sent_at = mover.sent.get(tuple(player["position"]))
+                        if sent_at is not None:
+                            self.stats.update_latencies.append(now - sent_at)
+                await websocket.send(protocol.encode({"type": "ack", "seq": event["seq"]}, self.wire))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def _play(self, websocket, deadline):
+        interval = 1 / self.args.rate
+        try:
+            while time.perf_counter() < deadline:
+                position = self.walker.step(interval)
+                self.input_seq += 1
+                event = {
+                    "type": "play",
+                    "seq": self.input_seq,
+                    "unique_id": self.unique_id,
+                    "nickname": self.nickname,
+                    "position": position,
+                    "level": self.level,
+                    "direction": self.walker.direction,
+                }
+                self.sent[tuple(position)] = time.perf_counter()
+                if len(self.sent) > 64:
+                    del self.sent[next(iter(self.sent))]
+                await websocket.send(protocol.encode(event, self.wire))
+                self.stats.sent += 1
+                await asyncio.sleep(interval)
+            await websocket.send(protocol.encode({"type": "exit"}, self.wire))
+        except websockets.exceptions.ConnectionClosed:
+            self.stats.errors += 1
+
+
+def _with_port(url, port):
+    scheme, rest = url.split("://", 1)
+    host = rest.split("/", 1)[0].rsplit(":", 1)[0]
+    return f"{scheme}://{host}:{port}/"
+
+
+async def _run_bots(indexes, args):
+    stats = Stats()
+    registry = {}
+    deadline = time.perf_counter() + args.duration
+    bots = []
+    for count, index in enumerate(indexes, 1):
+        bot = Bot(index, args, stats, registry)
+        bots.append(asyncio.create_task(bot.run(deadline)))
+        if count % args.room_capacity == 0:
+            # Spread the joins instead of hammering the server all at once, a game's worth at a time.
+            await asyncio.sleep(args.room_capacity / args.join_rate)
+    reported = set()
+    for result in await asyncio.gather(*bots, return_exceptions=True):
+        if isinstance(result, Exception):
+            stats.errors += 1
+            if type(result) not in reported:
+                # Once per kind of error, or a broken run would look like a bad server.
+                reported.add(type(result))
+                print(f"Bot failed: {result!r}")
+    return stats
+
+
+def _process(indexes, args):
+    """Entry point of a bot process."""
+    if args.url.startswith("wss://"):
+        # Self-signed certificates are expected on a load test server.
+        args.ssl = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        args.ssl.check_hostname = False
+        args.ssl.verify_mode = ssl.CERT_NONE
+    else:
+        args.ssl = None
+    return asyncio.run(_run_bots(indexes, args))
+
+
+def _percentile(values, percent):
+    if not values:
+        return float("nan")
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100)[percent - 1]
+
+
+def main():
+    """Runs the bots and prints what they measured."""
+    parser = argparse.ArgumentParser(description="Headless bot swarm for the game server.")
+    parser.add_argument("--url", default="ws://127.0.0.1:8001", help="ws:// for a server started with --no-tls")
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--duration", type=float, default=30, help="seconds each bot plays")
+    parser.add_argument("--rate", type=float, default=20, help="play messages per second and per bot")
+    parser.add_argument("--join-rate", type=float, default=50, help="joins per second and per process")
+    parser.add_argument("--levels", type=int, nargs="+", default=levels.available_levels())
+    parser.add_argument("--protocol", default=protocol.BINARY, choices=protocol.SUPPORTED)
+    parser.add_argument("--mux", action="store_true", help="use a single multiplexed connection per bot")
+    parser.add_argument("--room-capacity", type=int, default=ROOM_CAPACITY, help="players per game on the server")
+    args = parser.parse_args()
+
+    # Whole games per process, so that bots measuring each other's updates share a process.
+    games = -(-args.bots // args.room_capacity)
+    processes = max(1, min(args.processes, games))
+    bounds = [index * games // processes * args.room_capacity for index in range(processes + 1)]
+    chunks = [range(start, min(stop, args.bots)) for start, stop in zip(bounds, bounds[1:])]
+    t0 = time.perf_counter()
+    stats = Stats()
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        for result in pool.starmap(_process, [(chunk, args) for chunk in chunks]):
+            stats.merge(result)
+    elapsed = time.perf_counter() - t0
+
+    print(f"{args.bots} bots, {processes} processes, {elapsed:.1f}s")
+    print(f"Joined: {len(stats.join_latencies)}, errors: {stats.errors}")
+    for name, values in (("Join latency", stats.join_latencies), ("Update delivery", stats.update_latencies)):
+        print(f"{name}: p50 {_percentile(values, 50) * 1000:.1f} ms, p99 {_percentile(values, 99) * 1000:.1f} ms")
+    print(f"Messages sent: {stats.sent / elapsed:.0f}/s, received: {stats.received / elapsed:.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
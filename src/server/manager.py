@@ -1,8 +1,66 @@
-import random
 import uuid
 
 from websockets.legacy.server import WebSocketServerProtocol
 
+# Numbers of the nicknames given to players who didn't pick one (or picked an invalid one).
+GUEST_NUMBERS = range(1000, 2001)
+MAX_NICKNAME_LENGTH = 12
+
+
+class SessionRegistry:
+    """Every player session of this server, indexed by unique_id, nickname and websocket (main or broadcast)."""
+
+    def __init__(self):
+        self.by_unique_id = {}
+        self.by_nickname = {}
+        self.by_websocket = {}
+
+    def __len__(self):
+        return len(self.by_unique_id)
+
+    def __iter__(self):
+        return iter(list(self.by_unique_id.values()))
+
+    def add(self, player):
+        """Registers a session that just said hello on its main websocket."""
+        self.by_unique_id[player.unique_id] = player
+        self.by_nickname[player.nickname] = player
+        self.by_websocket[player.websocket] = player
+
+    def remove(self, player):
+        """
+        Forgets a session whose main socket closed.
+
+        Its broadcast socket stays indexed until it closes too, see `detach_broadcast`.
+        """
+        # A newer session may have taken over the unique_id (reconnection) or the nickname, keep that one.
+        if self.by_unique_id.get(player.unique_id) is player:
+            del self.by_unique_id[player.unique_id]
+        if self.by_nickname.get(player.nickname) is player:
+            del self.by_nickname[player.nickname]
+        if self.by_websocket.get(player.websocket) is player:
+            del self.by_websocket[player.websocket]
+
+    def get(self, unique_id):
+        """Returns the session of a unique_id, None if there is none."""
+        return self.by_unique_id.get(unique_id)
+
+    def attach_broadcast(self, unique_id, websocket):
+        """Gives its broadcast socket to the session of `unique_id`, returns it (None if it already has one)."""
+        player = self.by_unique_id.get(unique_id)
+        if player is None or player.broadcast is not None:
+            return None
+        player.attach_broadcast(websocket)
+        self.by_websocket[websocket] = player
+        return player
+
+    def detach_broadcast(self, websocket):
+        """The broadcast socket of a session is closing, returns that session (None if there is none)."""
+        player = self.by_websocket.pop(websocket, None)
+        if player is not None and player.broadcast is websocket:
+            player.detach_broadcast()
+        return player
+
 
 class ConnectionManager:
     """It handles ALL players websockets"""
@@ -10,7 +68,9 @@ class ConnectionManager:
     def __init__(self):
         self.active_connections: set[WebSocketServerProtocol] = set()
         self.active_broadcasts: set[WebSocketServerProtocol] = set()
-        self.active_nicknames = []
+        self.active_nicknames = set()
+        # Guest numbers that are not in use, see `allocate_nickname`.
+        self.free_guests = set(GUEST_NUMBERS)
 
     async def add_main(self, websocket: WebSocketServerProtocol):
         """Accepts a new Player's websocket and adds it to the list."""
@@ -28,28 +88,46 @@ class ConnectionManager:
         """Handles proper disconnect of a Player and removes websocket from the list."""
         self.active_broadcasts.remove(websocket)
 
-    async def update(self, payload):
+    async def update(self, payload, new_unique_id=None):
         """Receives JSON payload from a websocket and updates client's unique_id if required."""
         if not self._is_valid(payload["unique_id"]):
             # Generate client's unique ID
-            payload["unique_id"] = uuid.uuid4().hex
-        if not payload["nickname"] or len(payload["nickname"]) > 12:
-            # If a nickname wasnt given, generate a random one
-            while True:
-                payload["nickname"] = f"Guest{random.randint(1000, 2000)}"
-                if payload["nickname"] not in self.active_nicknames:
-                    self.active_nicknames.append(payload["nickname"])
-                    break
-        elif payload["nickname"] not in self.active_nicknames:
-            self.active_nicknames.append(payload["nickname"])
-        else:
-            while True:
-                payload["nickname"] += str(random.randint(1, 10))
-                if payload["nickname"] not in self.active_nicknames:
-                    self.active_nicknames.append(payload["nickname"])
-                    break
+            payload["unique_id"] = new_unique_id() if new_unique_id else uuid.uuid4().hex
+        payload["nickname"] = self.allocate_nickname(payload["nickname"])
         return payload
 
+    def allocate_nickname(self, wanted):
+        """Reserves a nickname as close as possible to the one wanted."""
+        if not wanted or len(wanted) > MAX_NICKNAME_LENGTH:
+            # If a nickname wasnt given, pick a free guest one
+            nickname = None
+            while self.free_guests and nickname is None:
+                nickname = f"Guest{self.free_guests.pop()}"
+                if nickname in self.active_nicknames:
+                    # Someone picked it on purpose.
+                    nickname = None
+            nickname = nickname or self._suffixed("Guest")
+        elif wanted in self.active_nicknames:
+            nickname = self._suffixed(wanted)
+        else:
+            nickname = wanted
+        self.active_nicknames.add(nickname)
+        return nickname
+
+    def release_nickname(self, nickname):
+        """Frees a nickname reserved by `allocate_nickname`."""
+        self.active_nicknames.discard(nickname)
+        number = nickname.removeprefix("Guest")
+        if number.isdigit() and int(number) in GUEST_NUMBERS and str(int(number)) == number:
+            self.free_guests.add(int(number))
+
+    def _suffixed(self, nickname):
+        """Returns the nickname followed by the first number that makes it free."""
+        suffix = 1
+        while f"{nickname}{suffix}" in self.active_nicknames:
+            suffix += 1
+        return f"{nickname}{suffix}"
+
     def _is_valid(self, uuid_to_test):
         """Checks validity of the uuid hex."""
         try:
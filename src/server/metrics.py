@@ -0,0 +1,178 @@
+"""
+Server metrics, exposed in the Prometheus text format on a local-only HTTP endpoint.
+
+Metrics are plain module globals, so that any module can record something with a single call:
+
+    metrics.messages_in.inc("play")
+    metrics.anticheat_seconds.observe(elapsed)
+"""
+import asyncio
+import bisect
+import logging
+import time
+
+# Seconds, from a fraction of a millisecond up to a few seconds.
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """A value that only goes up, optionally split by labels."""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        """Increments the counter of the given label values."""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        """Returns the lines of this metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_labels(self.labels, key)} {value}" for key, value in self.values.items())
+        return lines
+
+
+class Gauge:
+    """A value read when the metrics are scraped, from a callback returning {label values: value}."""
+
+    def __init__(self, name, description, labels=(), callback=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.callback = callback
+        _registry.append(self)
+
+    def render(self):
+        """Returns the lines of this metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        if self.callback is not None:
+            lines.extend(f"{self.name}{_labels(self.labels, key)} {value}" for key, value in self.callback().items())
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values, optionally split by labels."""
+
+    def __init__(self, name, description, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # Label values => [count per bucket (+Inf last), sum, count]
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        """Records a value for the given label values."""
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def time(self, *labels):
+        """Context manager observing how long its block took."""
+        return _Timer(self, labels)
+
+    def render(self):
+        """Returns the lines of this metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{_labels((*self.labels, 'le'), (*key, bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.t0, *self.labels)
+
+
+messages_in = Counter("orcs_messages_in_total", "Messages received, by type.", ("type",))
+messages_out = Counter("orcs_messages_out_total", "Messages sent, by type.", ("type",))
+bytes_in = Counter("orcs_bytes_in_total", "Bytes received, by message type.", ("type",))
+bytes_out = Counter("orcs_bytes_out_total", "Bytes sent, by message type.", ("type",))
+decode_seconds = Histogram("orcs_decode_seconds", "Time spent decoding a message.", ("protocol",))
+encode_seconds = Histogram("orcs_encode_seconds", "Time spent encoding a message.", ("protocol",))
+anticheat_seconds = Histogram("orcs_anticheat_seconds", "Time spent checking a play event.")
+rejected_moves = Counter("orcs_rejected_moves_total", "Play events rejected by the movement checks.", ("reason",))
+fanout_size = Histogram("orcs_fanout_size", "Players a snapshot tick was sent to.", buckets=SIZE_BUCKETS)
+fanout_seconds = Histogram("orcs_fanout_seconds", "Time spent building and queuing the snapshots of a tick.")
+ping_rtt_seconds = Histogram("orcs_ping_rtt_seconds", "Round trip time of the pings sent to clients.")
+dead_peers = Counter("orcs_dead_peers_total", "Connections closed because they stopped answering pings.")
+loop_lag_seconds = Histogram("orcs_event_loop_lag_seconds", "How late the event loop wakes up timers.")
+db_seconds = Histogram("orcs_db_seconds", "Database query latency, queueing included.", ("query",))
+
+
+def render():
+    """Returns every metric in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def monitor_loop_lag(interval=0.5):
+    """Measures how late the event loop is to wake up a sleeping task."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - expected))
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+        if path == b"/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host="127.0.0.1", port=9100):
+    """Starts the metrics endpoint. It only listens locally by default, this is not meant to be public."""
+    server = await asyncio.start_server(_handle, host, port)
+    logging.info(f"Metrics available on http://{host}:{port}/metrics")
+    return server
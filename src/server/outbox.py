@@ -0,0 +1,74 @@
+import asyncio
+import collections
+import logging
+import time
+
+# How many control messages (pings...) can wait for a slow client before the oldest ones are dropped.
+OUTBOX_SIZE = 8
+
+
+class Outbox:
+    """
+    Bounded queue of the messages waiting to be sent on a broadcast socket.
+
+    Snapshots are deltas from the last one the client acknowledged, so a newer snapshot always supersedes
+    an older one that wasn't sent yet: only the latest is kept. A slow client therefore never makes the
+    server pile up obsolete updates, it just gets fewer (and fresher) ones.
+    """
+
+    def __init__(self, websocket, size=OUTBOX_SIZE):
+        self.websocket = websocket
+        self.messages = collections.deque(maxlen=size)
+        self.snapshot = None
+        self.dropped = 0
+        # When the oldest message still waiting was queued, None if there is nothing to send.
+        self.waiting_since = None
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def lag(self):
+        """How long (in seconds) the oldest queued message has been waiting."""
+        if self.waiting_since is None:
+            return 0.0
+        return time.perf_counter() - self.waiting_since
+
+    def put(self, message):
+        """Queues a control message, dropping the oldest one if the client is too far behind."""
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped += 1
+        self.messages.append(message)
+        self._wake()
+
+    def put_snapshot(self, message):
+        """Queues a snapshot, replacing the one still waiting if any."""
+        if self.snapshot is not None:
+            self.dropped += 1
+        self.snapshot = message
+        self._wake()
+
+    def close(self):
+        """Stops sending, whatever is still queued is dropped."""
+        self._task.cancel()
+
+    def _wake(self):
+        if self.waiting_since is None:
+            self.waiting_since = time.perf_counter()
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.messages or self.snapshot is not None:
+                if self.messages:
+                    message = self.messages.popleft()
+                else:
+                    message, self.snapshot = self.snapshot, None
+                try:
+                    # This waits for the socket's buffer to drain, so slow clients coalesce instead of piling up.
+                    await self.websocket.send(message)
+                except Exception as e:
+                    logging.info(f"Stopped sending to a broadcast socket: {e!r}")
+                    return
+            self.waiting_since = None
@@ -0,0 +1,128 @@
+import asyncio
+import collections
+import logging
+import time
+
+# How many players' progress we keep in memory.
+CACHE_SIZE = 10_000
+# How often (in seconds) changed progress is written to the database.
+FLUSH_INTERVAL = 30
+
+
+class ProgressCache:
+    """
+    Write-behind cache of the players' progress, in front of `GameDatabase`.
+
+    Players reconnecting shortly after leaving are served from memory, and saving only marks them dirty:
+    dirty entries are written in the background every `flush_interval` seconds, when they get evicted
+    (least recently used first) and when the server stops.
+    """
+
+    def __init__(self, db, size=CACHE_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.db = db
+        self.size = size
+        self.flush_interval = flush_interval
+        # unique_id => level, least recently used first.
+        self.levels = collections.OrderedDict()
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self._writes = set()
+        self._task = None
+
+    def start(self):
+        """Starts flushing periodically."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stops flushing periodically and writes everything that is still dirty."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self._writes:
+            await asyncio.gather(*self._writes)
+
+    async def load(self, unique_id):
+        """Returns a player's level, only hitting the database if we don't know it yet."""
+        if unique_id in self.levels:
+            self.hits += 1
+            self.levels.move_to_end(unique_id)
+            return self.levels[unique_id]
+        self.misses += 1
+        level = await self.db.load(unique_id)
+        if unique_id not in self.levels:
+            # Unless it got saved while we were waiting for the database.
+            self._put(unique_id, level)
+        return self.levels.get(unique_id, level)
+
+    async def save(self, player):
+        """Saves a player's progress in memory, it will be written to the database later."""
+        if player.level is None:
+            return
+        level = int(player.level)
+        old = self.levels.get(player.unique_id)
+        if old is not None and old >= level:
+            # Progress is only ever saved if the player went further.
+            self.levels.move_to_end(player.unique_id)
+            return
+        self._put(player.unique_id, level)
+        self.dirty.add(player.unique_id)
+
+    async def flush(self):
+        """Writes every dirty entry to the database."""
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        t0 = time.perf_counter()
+        # The database thread writes all of these in as few commits as it can.
+        try:
+            await asyncio.gather(*(self.db.save_level(unique_id, self.levels[unique_id]) for unique_id in dirty))
+        except Exception:
+            # Try again on the next flush.
+            self.dirty.update(unique_id for unique_id in dirty if unique_id in self.levels)
+            raise
+        elapsed = time.perf_counter() - t0
+        self.flushes += 1
+        self.flushed += len(dirty)
+        self.flush_seconds += elapsed
+        self.last_flush_seconds = elapsed
+        logging.info(f"Flushed the progress of {len(dirty)} players in {elapsed:.3f}s")
+
+    def stats(self):
+        """Returns the counters of the cache."""
+        return {
+            "size": len(self.levels),
+            "dirty": len(self.dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "flush_seconds": self.flush_seconds,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+    def _put(self, unique_id, level):
+        self.levels[unique_id] = level
+        self.levels.move_to_end(unique_id)
+        while len(self.levels) > self.size:
+            evicted, evicted_level = self.levels.popitem(last=False)
+            if evicted in self.dirty:
+                # Too bad, this one has to be written right away.
+                self.dirty.discard(evicted)
+                write = asyncio.ensure_future(self.db.save_level(evicted, evicted_level))
+                self._writes.add(write)
+                write.add_done_callback(self._writes.discard)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Failed to flush the progress cache.")
@@ -0,0 +1,224 @@
+"""
+Wire protocol shared by the server and the client.
+
+The hello (`init`/`ready`) is always JSON. The client lists the protocols it knows in it,
+and the server answers with the one it picked. Afterwards, `play`, `update`, `ping`, `ack`, `exit` and `inputs`
+events are sent as compact binary frames when both sides speak `bin2`, everything else stays JSON.
+JSON is kept as a fallback, and because it is way easier to read when debugging.
+
+`play` events are numbered (`seq`), and the server acknowledges them cumulatively: the last one it processed
+is sent along the player's next update (`ack`), or in an `inputs` event if there is no update to send.
+
+Binary frames start with a `<BB` header (protocol version, event tag).
+Players are referred to by their server-assigned id, the nickname is only sent along a player's full state.
+Updates can also carry the latency of their recipient, older servers sent it in "ping" events (see `annotate`).
+"""
+import json
+import struct
+
+VERSION = 2
+BINARY = "bin2"
+JSON = "json"
+# Ordered by preference.
+SUPPORTED = (BINARY, JSON)
+
+_HEADER = struct.Struct("<BB")
+_PLAY = struct.Struct("<IiihB")
+_UPDATE = struct.Struct("<IIHH")
+_ENTRY = struct.Struct("<IB")
+_POSITION = struct.Struct("<ii")
+_LEVEL = struct.Struct("<h")
+_BYTE = struct.Struct("<B")
+_ID = struct.Struct("<I")
+_SEQ = struct.Struct("<I")
+_LATENCY = struct.Struct("<f")
+
+_TAGS = {"play": 1, "update": 2, "ping": 3, "ack": 4, "exit": 5, "inputs": 6}
+_TYPES = {tag: event_type for event_type, tag in _TAGS.items()}
+_DIRECTIONS = ("r", "l")
+# Update entries only carry the fields flagged in their mask.
+_NICKNAME, _POS, _LVL, _DIR = 1, 2, 4, 8
+_NO_BASELINE = 0xFFFFFFFF
+# Optional fields at the end of an update, flagged in its last byte.
+_LATENCY_FIELD, _ACK_FIELD = 1, 2
+
+
+def negotiate(offered):
+    """Picks the protocol to use from the ones offered by the client, JSON if we have nothing in common."""
+    for protocol in offered or ():
+        if protocol in SUPPORTED:
+            return protocol
+    return JSON
+
+
+def encode(event, protocol=JSON):
+    """Serializes an event for the given protocol. Events without a binary layout are sent as JSON."""
+    if protocol != BINARY or event["type"] not in _TAGS:
+        return json.dumps(event)
+    event_type = event["type"]
+    header = _HEADER.pack(VERSION, _TAGS[event_type])
+    match event_type:
+        case "play":
+            x, y = event["position"]
+            level, direction = _level(event["level"]), _DIRECTIONS.index(event["direction"])
+            return header + _PLAY.pack(event["seq"], x, y, level, direction)
+        case "update":
+            entries = [encode_entry(player, BINARY) for player in event["players"]]
+            left = event.get("left")
+            return encode_update(event.get("game_id"), event["seq"], event["baseline"], entries, left, BINARY)
+        case "ping":
+            return header + _LATENCY.pack(float(event["latency"]))
+        case "ack":
+            return header + _SEQ.pack(event["seq"])
+        case "inputs":
+            return header + _SEQ.pack(event["ack"])
+    return header
+
+
+def decode(message):
+    """Deserializes a message, whatever protocol it was sent with."""
+    if isinstance(message, str):
+        return json.loads(message)
+    version, tag = _HEADER.unpack_from(message)
+    if version != VERSION:
+        raise ValueError(f"Unsupported protocol version: {version}")
+    event_type = _TYPES[tag]
+    offset = _HEADER.size
+    match event_type:
+        case "play":
+            seq, x, y, level, direction = _PLAY.unpack_from(message, offset)
+            return {
+                "type": "play",
+                "seq": seq,
+                "position": [x, y],
+                "level": level,
+                "direction": _DIRECTIONS[direction],
+            }
+        case "update":
+            return _decode_update(message, offset)
+        case "ping":
+            (latency,) = _LATENCY.unpack_from(message, offset)
+            return {"type": "ping", "latency": f"{latency:.2f}"}
+        case "ack":
+            (seq,) = _SEQ.unpack_from(message, offset)
+            return {"type": "ack", "seq": seq}
+        case "inputs":
+            (seq,) = _SEQ.unpack_from(message, offset)
+            return {"type": "inputs", "ack": seq}
+    return {"type": event_type}
+
+
+def _level(level):
+    """Levels are unknown (None) until the player's progress is loaded."""
+    return -1 if level is None else int(level)
+
+
+def encode_entry(player, protocol=JSON):
+    """Serializes one player entry of an update, so that it can be cached and reused in many updates."""
+    if protocol != BINARY:
+        return json.dumps(player)
+    mask = (
+        ("nickname" in player and _NICKNAME)
+        | ("position" in player and _POS)
+        | ("level" in player and _LVL)
+        | ("direction" in player and _DIR)
+    )
+    parts = [_ENTRY.pack(player["id"], mask)]
+    if mask & _NICKNAME:
+        nickname = player["nickname"].encode()
+        parts.append(_BYTE.pack(len(nickname)) + nickname)
+    if mask & _POS:
+        parts.append(_POSITION.pack(*player["position"]))
+    if mask & _LVL:
+        parts.append(_LEVEL.pack(_level(player["level"])))
+    if mask & _DIR:
+        parts.append(_BYTE.pack(_DIRECTIONS.index(player["direction"])))
+    return b"".join(parts)
+
+
+def encode_update(game_id, seq, baseline, entries, left=None, protocol=JSON):
+    """Assembles an "update" event from player entries already serialized with `encode_entry`."""
+    left = left or []
+    if protocol != BINARY:
+        head = json.dumps({"type": "update", "game_id": game_id, "seq": seq, "baseline": baseline})
+        tail = f', "left": {json.dumps(left)}' if left else ""
+        return f'{head[:-1]}, "players": [{", ".join(entries)}]{tail}}}'
+    return b"".join(
+        (
+            _HEADER.pack(VERSION, _TAGS["update"]),
+            _UPDATE.pack(seq, _NO_BASELINE if baseline is None else baseline, len(entries), len(left)),
+            *entries,
+            *(_ID.pack(player_id) for player_id in left),
+        )
+    )
+
+
+def annotate(update, protocol=JSON, latency=None, ack=None):
+    """
+    Piggybacks data only meant for its recipient on an encoded "update" event.
+
+    That is its latency (ping round trip time, in seconds) and the last of its `play` events that was processed.
+    The update itself stays shared between every recipient, this only appends to it.
+    """
+    if latency is None and ack is None:
+        return update
+    if protocol != BINARY:
+        extra = ""
+        if latency is not None:
+            extra += f', "latency": "{latency:.2f}"'
+        if ack is not None:
+            extra += f', "ack": {ack}'
+        return f"{update[:-1]}{extra}}}"
+    # Optional trailer, after the ids of the players who left: the fields, then which ones are there.
+    parts = [update]
+    if latency is not None:
+        parts.append(_LATENCY.pack(latency))
+    if ack is not None:
+        parts.append(_SEQ.pack(ack))
+    parts.append(_BYTE.pack((latency is not None and _LATENCY_FIELD) | (ack is not None and _ACK_FIELD)))
+    return b"".join(parts)
+
+
+def _decode_update(message, offset):
+    seq, baseline, count, left_count = _UPDATE.unpack_from(message, offset)
+    offset += _UPDATE.size
+    players = []
+    for _ in range(count):
+        player_id, mask = _ENTRY.unpack_from(message, offset)
+        offset += _ENTRY.size
+        player = {"id": player_id}
+        if mask & _NICKNAME:
+            (length,) = _BYTE.unpack_from(message, offset)
+            offset += _BYTE.size
+            player["nickname"] = message[offset : offset + length].decode()
+            offset += length
+        if mask & _POS:
+            player["position"] = list(_POSITION.unpack_from(message, offset))
+            offset += _POSITION.size
+        if mask & _LVL:
+            (player["level"],) = _LEVEL.unpack_from(message, offset)
+            offset += _LEVEL.size
+        if mask & _DIR:
+            (direction,) = _BYTE.unpack_from(message, offset)
+            player["direction"] = _DIRECTIONS[direction]
+            offset += _BYTE.size
+        players.append(player)
+    left = [_ID.unpack_from(message, offset + index * _ID.size)[0] for index in range(left_count)]
+    update = {
+        "type": "update",
+        "seq": seq,
+        "baseline": None if baseline == _NO_BASELINE else baseline,
+        "players": players,
+    }
+    if left:
+        update["left"] = left
+    offset += left_count * _ID.size
+    if len(message) > offset:
+        (fields,) = _BYTE.unpack_from(message, len(message) - _BYTE.size)
+        if fields & _LATENCY_FIELD:
+            (latency,) = _LATENCY.unpack_from(message, offset)
+            update["latency"] = f"{latency:.2f}"
+            offset += _LATENCY.size
+        if fields & _ACK_FIELD:
+            (update["ack"],) = _SEQ.unpack_from(message, offset)
+    return update
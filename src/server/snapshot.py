@@ -0,0 +1,52 @@
+import protocol
+
+# Public fields of a player, in the order used by `PlayerSession.state`.
+FIELDS = ("nickname", "position", "level", "direction")
+
+
+def _entry(player_id, state, fields):
+    """Builds the entry of a player, only with the given fields."""
+    entry = {"id": player_id}
+    for index, field in enumerate(FIELDS):
+        if field in fields:
+            value = state[index]
+            entry[field] = list(value) if field == "position" else value
+    return entry
+
+
+def diff(baseline, view):
+    """
+    Compares two snapshots (dicts of player id => state tuple).
+
+    Returns the ids of the players that have to be sent in full (new ones, or everyone if there is no baseline),
+    the entries of the players that changed (only with the changed fields) and the ids of the players that are gone.
+    """
+    if baseline is None:
+        return list(view), [], []
+    full = []
+    changed = []
+    for player_id, state in view.items():
+        old = baseline.get(player_id)
+        if old is None:
+            full.append(player_id)
+        elif old != state:
+            fields = tuple(field for index, field in enumerate(FIELDS) if old[index] != state[index])
+            changed.append(_entry(player_id, state, fields))
+    left = [player_id for player_id in baseline if player_id not in view]
+    return full, changed, left
+
+
+def encode(game_id, seq, baseline_seq, baseline, view, sessions, wire):
+    """
+    Serializes snapshot `seq`, as a delta from `baseline` if we have one.
+
+    Players sent in full reuse the fragment cached in their session (see `PlayerSession.fragment`),
+    so they are only serialized again when they change.
+    Returns None if the delta would be empty.
+    """
+    full, changed, left = diff(baseline, view)
+    if baseline is not None and not (full or changed or left):
+        return None
+    entries = [sessions[player_id].fragment(wire) for player_id in full]
+    entries.extend(protocol.encode_entry(entry, wire) for entry in changed)
+    return protocol.encode_update(game_id, seq, baseline_seq if baseline is not None else None, entries, left, wire)
@@ -0,0 +1,92 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import time
+import uuid
+
+# A worker dying sooner than this (in seconds) after being started isn't restarted, see `WorkerRouter.spawn`.
+MIN_UPTIME = 10
+
+
+class WorkerRouter:
+    """
+    Routes players to the server worker that owns them.
+
+    All workers share the public port (SO_REUSEPORT), so the kernel hands a new connection to any of them.
+    Each worker also listens on its own port (public port + 1 + index). A player belongs to the worker
+    picked by its `unique_id`, so its main and broadcast sockets (and thus its game) always end up on the
+    same worker: a worker receiving someone else's player just tells the client where to reconnect.
+    """
+
+    def __init__(self, index=0, count=1, port=8001):
+        self.index = index
+        self.count = count
+        self.port = port
+
+    @property
+    def private_port(self):
+        """The port only this worker listens on."""
+        return self.port_of_worker(self.index)
+
+    def port_of_worker(self, index):
+        """Returns the private port of a worker."""
+        return self.port + 1 + index
+
+    def worker_of(self, unique_id):
+        """Returns the index of the worker owning a player."""
+        return uuid.UUID(str(unique_id)).int % self.count
+
+    def owns(self, unique_id):
+        """Checks if a player belongs to this worker. New players (without a valid unique_id) belong to anyone."""
+        if self.count == 1:
+            return True
+        try:
+            return self.worker_of(unique_id) == self.index
+        except ValueError:
+            return True
+
+    def redirect(self, unique_id):
+        """Returns the event telling a client which port its worker listens on."""
+        return {"type": "redirect", "port": self.port_of_worker(self.worker_of(unique_id))}
+
+    def new_unique_id(self):
+        """Generates a unique_id owned by this worker, so that new players never have to be redirected."""
+        while True:
+            unique_id = uuid.uuid4().hex
+            if self.owns(unique_id):
+                return unique_id
+
+    def spawn(self, target, *args):
+        """
+        Starts one process per worker, each calling `target(router, *args)`, and keeps them running.
+
+        The other workers keep sending a worker's players to its private port, so a worker that dies is restarted.
+        If it died right after starting, restarting it wouldn't help: every worker is stopped instead.
+        """
+        # Spawn (rather than fork) so that each worker opens its own database connection and event loop.
+        context = multiprocessing.get_context("spawn")
+        # Process sentinel => (worker index, process, when it was started)
+        workers = {}
+
+        def start(index):
+            router = WorkerRouter(index, self.count, self.port)
+            process = context.Process(target=target, args=(router, *args), daemon=True)
+            process.start()
+            workers[process.sentinel] = (index, process, time.monotonic())
+
+        try:
+            for index in range(self.count):
+                start(index)
+            while True:
+                for sentinel in multiprocessing.connection.wait(list(workers)):
+                    index, process, started_at = workers.pop(sentinel)
+                    process.join()
+                    logging.error(f"Worker {index} exited with code {process.exitcode}.")
+                    if time.monotonic() - started_at < MIN_UPTIME:
+                        raise RuntimeError(f"Worker {index} died right after starting, stopping the server.")
+                    start(index)
+        finally:
+            for _, process, _ in workers.values():
+                process.terminate()
+            for _, process, _ in workers.values():
+                process.join()